@@ -1,3 +1,4 @@
+import importlib.metadata
 import logging
 
 from packaging import version
@@ -16,13 +17,13 @@ logger.setLevel(logging.INFO)
 logger.addHandler(handler)
 logger.propagate = False
 
+# Check the version without importing pycolmap, which is slow to load.
 try:
-    import pycolmap
-except ImportError:
+    found_version = importlib.metadata.version("pycolmap")
+except importlib.metadata.PackageNotFoundError:
     logger.warning("pycolmap is not installed, some features may not work.")
 else:
     min_version = version.parse("0.6.0")
-    found_version = pycolmap.__version__
     if found_version != "dev":
         version = version.parse(found_version)
         if version < min_version:
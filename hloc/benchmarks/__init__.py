@@ -0,0 +1,55 @@
+import multiprocessing
+import resource
+import time
+from queue import Empty
+from typing import Callable, Dict, Optional
+
+
+def peak_rss_mb() -> float:
+    """The peak resident memory of the current process."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run(queue: multiprocessing.Queue, fn: Callable[..., Dict], args: tuple):
+    try:
+        result = fn(*args)
+    except Exception as error:
+        result = {"error": repr(error)}
+    queue.put(result)
+
+
+def run_in_process(
+    fn: Callable[..., Dict],
+    *args,
+    timeout: Optional[float] = None,
+    poll_interval: float = 1.0,
+) -> Dict:
+    """Run `fn(*args)` in a fresh process, such that its peak memory is not
+    shared with the other runs, and return the dictionary that it returns.
+    An exception, an exit without result, e.g. when the process is killed for
+    lack of memory, or a timeout is returned as {"error": message}.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run, args=(queue, fn, args))
+    process.start()
+    start = time.time()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=poll_interval)
+        except Empty:
+            if not process.is_alive():
+                # The result may have been sent just before the exit.
+                try:
+                    result = queue.get(timeout=poll_interval)
+                except Empty:
+                    result = {"error": f"Exited with code {process.exitcode}."}
+            elif timeout is not None and time.time() - start > timeout:
+                process.kill()
+                result = {"error": f"Timed out after {timeout}s."}
+    process.join()
+    if process.exitcode != 0 and "error" not in result:
+        result["error"] = f"Exited with code {process.exitcode}."
+    return result
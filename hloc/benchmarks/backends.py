@@ -0,0 +1,111 @@
+"""
+Check that the TorchScript and ONNX backends of the extractors give the same
+features as the eager models on the images of `image_dir`, i.e. the same
+number of keypoints and outputs within a tolerance, and compare their run time
+on the CPU. The exit code is non-zero if some backend differs, e.g.:
+
+python -m hloc.benchmarks.backends --image_dir datasets/sacre_coeur/mapping \
+    --confs superpoint_aachen netvlad --backends torchscript onnx
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from .. import extract_features, logger
+
+
+@torch.no_grad()
+def run(
+    conf: Dict, dataset: extract_features.ImageDataset
+) -> Tuple[List[Dict[str, np.ndarray]], float]:
+    """Return the predictions of the model for each image and their run time."""
+    model = extract_features.load_model(conf, "cpu")
+    preds = []
+    duration = 0
+    for data in dataset:
+        image = extract_features.normalize_image(torch.from_numpy(data["image"]))
+        start = time.time()
+        pred = model({"image": image[None]})
+        duration += time.time() - start
+        preds.append({k: v[0].numpy() for k, v in pred.items()})
+    return preds, duration
+
+
+def max_difference(preds: List[Dict], reference: List[Dict]) -> Dict[str, float]:
+    """The largest absolute difference of each output, e.g. of the keypoints and
+    of the descriptors, or infinity if they differ in shape, e.g. when they have
+    different numbers of keypoints.
+    """
+    diff = {k: 0.0 for k in reference[0]} if reference else {}
+    for pred, ref in zip(preds, reference):
+        for k, v in ref.items():
+            if k not in pred or pred[k].shape != v.shape:
+                diff[k] = np.inf
+            elif v.size > 0:
+                diff[k] = max(diff[k], float(np.abs(pred[k] - v).max()))
+    return diff
+
+
+def main(
+    image_dir: Path,
+    confs: List[str] = ("superpoint_aachen", "netvlad"),
+    backends: List[str] = ("torchscript", "onnx"),
+    num_images: int = 10,
+    tolerance: float = 1e-4,
+) -> List[Dict]:
+    results = []
+    for name in confs:
+        conf = extract_features.confs[name]
+        dataset = extract_features.ImageDataset(image_dir, conf["preprocessing"])
+        dataset.names = dataset.names[:num_images]
+        reference, reference_duration = run(conf, dataset)
+        for backend in backends:
+            conf_backend = {**conf, "model": {**conf["model"], "backend": backend}}
+            preds, duration = run(conf_backend, dataset)
+            diff = max_difference(preds, reference)
+            result = {
+                "conf": name,
+                "backend": backend,
+                "max_difference": diff,
+                "identical": all(d <= tolerance for d in diff.values()),
+                "speedup": reference_duration / duration,
+            }
+            results.append(result)
+            logger.info(
+                "%s with %s: %.2fx the speed of eager, max difference of %s",
+                name,
+                backend,
+                result["speedup"],
+                ", ".join(f"{d:.2g} ({k})" for k, d in diff.items()),
+            )
+            if not result["identical"]:
+                logger.error(f"The {backend} {name} features differ from eager.")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", type=Path, required=True)
+    parser.add_argument(
+        "--confs", type=str, nargs="+", default=["superpoint_aachen", "netvlad"]
+    )
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=["torchscript", "onnx"],
+        choices=["torchscript", "onnx"],
+    )
+    parser.add_argument("--num_images", type=int, default=10)
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+    results = main(
+        args.image_dir, args.confs, args.backends, args.num_images, args.tolerance
+    )
+    sys.exit(not all(r["identical"] for r in results))
@@ -0,0 +1,113 @@
+"""
+Compare float16 and int8 storage of the local descriptors of a feature file:
+size on disk, read throughput, and recall of the mutual nearest neighbor matches
+obtained with int8 descriptors w.r.t. those obtained with float16 descriptors.
+
+python -m hloc.benchmarks.descriptors \
+    --features outputs/feats-superpoint-n4096-r1024.h5 --pairs outputs/pairs.txt
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import h5py
+import numpy as np
+import torch
+
+from .. import logger
+from ..matchers.nearest_neighbor import NearestNeighbor
+from ..utils.io import list_h5_names, quantize, read_features
+from ..utils.parsers import parse_retrieval
+
+
+def convert(feature_path: Path, output_path: Path, names: List[str], int8: bool):
+    with h5py.File(str(feature_path), "r") as fd, h5py.File(
+        str(output_path), "w", libver="latest"
+    ) as fd_out:
+        for name in names:
+            features = read_features(fd[name])
+            desc = features["descriptors"]
+            if int8:
+                features["descriptors"], features["descriptors_scale"] = quantize(desc)
+            else:
+                features["descriptors"] = desc.astype(np.float16)
+            grp = fd_out.create_group(name)
+            for k, v in features.items():
+                grp.create_dataset(k, data=v)
+
+
+def read_all(path: Path, names: List[str]) -> Tuple[Dict[str, np.ndarray], float]:
+    start = time.time()
+    descriptors = {}
+    with h5py.File(str(path), "r", libver="latest") as fd:
+        for name in names:
+            descriptors[name] = read_features(fd[name])["descriptors"]
+    return descriptors, time.time() - start
+
+
+def match(matcher, desc0: np.ndarray, desc1: np.ndarray) -> np.ndarray:
+    pred = matcher(
+        {
+            "descriptors0": torch.from_numpy(desc0).float()[None],
+            "descriptors1": torch.from_numpy(desc1).float()[None],
+        }
+    )
+    return pred["matches0"][0].numpy()
+
+
+@torch.no_grad()
+def main(
+    feature_path: Path,
+    pairs_path: Optional[Path] = None,
+    max_images: int = 500,
+) -> Dict:
+    names = list_h5_names(feature_path)
+    if pairs_path is not None:
+        pairs = [(q, r) for q, rs in parse_retrieval(pairs_path).items() for r in rs]
+        pairs = [(i, j) for i, j in pairs if i in names and j in names]
+    else:
+        names = sorted(names)
+        pairs = list(zip(names[:-1], names[1:]))
+    pairs = pairs[:max_images]
+    names = sorted(set(n for p in pairs for n in p))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        descriptors = {}
+        for fmt in ("float16", "int8"):
+            path = Path(tmp_dir, f"{fmt}.h5")
+            convert(feature_path, path, names, fmt == "int8")
+            descriptors[fmt], duration = read_all(path, names)
+            num_kpts = sum(d.shape[-1] for d in descriptors[fmt].values())
+            results[fmt] = {
+                "bytes_per_keypoint": path.stat().st_size / num_kpts,
+                "keypoints_per_sec": num_kpts / duration,
+            }
+
+    matcher = NearestNeighbor({"do_mutual_check": True}).eval()
+    num_ref = num_found = 0
+    for name0, name1 in pairs:
+        ref = match(
+            matcher, descriptors["float16"][name0], descriptors["float16"][name1]
+        )
+        m = match(matcher, descriptors["int8"][name0], descriptors["int8"][name1])
+        valid = ref > -1
+        num_ref += valid.sum()
+        num_found += (m[valid] == ref[valid]).sum()
+    results["int8"]["match_recall"] = num_found / max(num_ref, 1)
+
+    for fmt, res in results.items():
+        logger.info(f"{fmt}: " + ", ".join(f"{k}={v:.4g}" for k, v in res.items()))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features", type=Path, required=True)
+    parser.add_argument("--pairs", type=Path)
+    parser.add_argument("--max_images", type=int, default=500)
+    args = parser.parse_args()
+    main(args.features, args.pairs, args.max_images)
@@ -0,0 +1,214 @@
+"""
+Measure the throughput of the feature extraction for several configurations,
+batch sizes and numbers of CPU threads. The images of `image_dir` are repeated
+to obtain enough batches and the results are written as JSON, e.g.:
+
+python -m hloc.benchmarks.extraction \
+    --image_dir datasets/sacre_coeur/mapping \
+    --confs superpoint_aachen disk netvlad --batch_sizes 1 4 --num_threads 1 8 \
+    --output outputs/benchmark_extraction.json
+
+Each measurement runs in a fresh process such that its peak memory is not
+affected by the previous ones. The time of each stage is measured by running
+them sequentially, while the throughput is that of the pipelined extraction.
+"""
+
+import argparse
+import json
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+import cv2
+import h5py
+import numpy as np
+import torch
+
+from .. import extract_features, logger
+from . import peak_rss_mb, run_in_process
+
+default_confs = [
+    "superpoint_aachen",
+    "disk",
+    "r2d2",
+    "d2net-ss",
+    "sift",
+    "netvlad",
+    "senet",
+    "eigenplaces",
+]
+
+
+def synchronize(device: str):
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def time_stages(
+    model: torch.nn.Module,
+    dataset: extract_features.ImageDataset,
+    feature_path: Path,
+    batch_size: int,
+    device: str,
+) -> Dict[str, float]:
+    """Run each stage of the extraction sequentially and return its total time."""
+    times = defaultdict(float)
+    detection_noise = getattr(model, "detection_noise", 1)
+    with h5py.File(str(feature_path), "a", libver="latest") as fd:
+        for start in range(0, len(dataset), batch_size):
+            items = []
+            for name in dataset.names[start : start + batch_size]:
+                t = time.time()
+                image, size = dataset.read(name, dataset.conf.grayscale, [dataset.conf])
+                times["decode"] += time.time() - t
+                t = time.time()
+                image = extract_features.preprocess_image(image, dataset.conf, size)
+                times["resize"] += time.time() - t
+                items.append(
+                    {"name": name, "image": image, "original_size": np.array(size)}
+                )
+
+            for data in extract_features.collate_by_shape(items):
+                synchronize(device)
+                t = time.time()
+                image = extract_features.normalize_image(data["image"].to(device))
+                pred = extract_features.forward_batch(model, image)
+                synchronize(device)
+                times["forward"] += time.time() - t
+
+                t = time.time()
+                preds = [
+                    {k: v[i].cpu().numpy() for k, v in pred.items()}
+                    for i in range(len(data["name"]))
+                ]
+                times["device_to_host"] += time.time() - t
+
+                t = time.time()
+                size = np.array(image.shape[-2:][::-1])
+                for name, pred_i, original_size in zip(
+                    data["name"], preds, data["original_size"]
+                ):
+                    pred_i, uncertainty = extract_features.postprocess_features(
+                        pred_i, size, original_size.numpy(), detection_noise
+                    )
+                    extract_features.write_features(fd, (name, pred_i, uncertainty))
+                times["write"] += time.time() - t
+    return dict(times)
+
+
+def benchmark(
+    conf: Dict,
+    image_dir: Path,
+    batch_size: int = 1,
+    num_threads: int = None,
+    num_images: int = 64,
+) -> Dict:
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+        cv2.setNumThreads(num_threads)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = extract_features.load_model(conf, device)
+    dataset = extract_features.ImageDataset(image_dir, conf["preprocessing"])
+    names = dataset.names
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        feature_path = Path(tmp_dir, "features.h5")
+        # Warm-up to exclude the lazy initialization of the backends.
+        dataset.names = names[:1]
+        extract_features.extract(model, dataset, feature_path, device=device)
+        feature_path.unlink()
+
+        dataset.names = (names * (num_images // len(names) + 1))[:num_images]
+        synchronize(device)
+        start = time.time()
+        extract_features.extract(
+            model, dataset, feature_path, batch_size=batch_size, device=device
+        )
+        synchronize(device)
+        duration = time.time() - start
+        num_bytes = feature_path.stat().st_size
+
+        feature_path.unlink()
+        stages = time_stages(model, dataset, feature_path, batch_size, device)
+
+    return {
+        "conf": conf["output"],
+        "device": device,
+        "batch_size": batch_size,
+        "num_threads": torch.get_num_threads(),
+        "num_images": len(dataset),
+        "images_per_sec": len(dataset) / duration,
+        "stage_ms_per_image": {k: 1e3 * v / len(dataset) for k, v in stages.items()},
+        "peak_rss_mb": peak_rss_mb(),
+        "output_bytes_per_image": num_bytes / len(dataset),
+    }
+
+
+def main(
+    conf_names: List[str],
+    image_dir: Path,
+    batch_sizes: List[int] = (1, 4),
+    num_threads: List[int] = (None,),
+    num_images: int = 64,
+    output: Path = None,
+) -> List[Dict]:
+    results = []
+    for name in conf_names:
+        conf = extract_features.confs[name]
+        for threads in num_threads:
+            for batch_size in batch_sizes:
+                args = (conf, image_dir, batch_size, threads, num_images)
+                result = run_in_process(benchmark, *args)
+                results.append(result)
+                if "error" in result:
+                    result.update(conf=conf["output"], batch_size=batch_size)
+                    result.update(num_threads=threads)
+                    logger.error(f"Could not benchmark {name}: {result['error']}")
+                    continue
+                logger.info(
+                    "%s batch_size=%d num_threads=%d: %.2f images/sec, %s ms/image",
+                    name,
+                    batch_size,
+                    result["num_threads"],
+                    result["images_per_sec"],
+                    {k: round(v, 1) for k, v in result["stage_ms_per_image"].items()},
+                )
+
+    if output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        output.parent.mkdir(exist_ok=True, parents=True)
+        with open(str(output), "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Wrote the results to {output}.")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--image_dir", type=Path, default=Path("datasets/sacre_coeur/mapping")
+    )
+    parser.add_argument(
+        "--confs",
+        type=str,
+        nargs="+",
+        default=default_confs,
+        choices=list(extract_features.confs.keys()),
+    )
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--num_threads", type=int, nargs="+", default=[None])
+    parser.add_argument("--num_images", type=int, default=64)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+    main(
+        args.confs,
+        args.image_dir,
+        args.batch_sizes,
+        args.num_threads,
+        args.num_images,
+        args.output,
+    )
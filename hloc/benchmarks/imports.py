@@ -0,0 +1,81 @@
+"""
+Measure the import time of the hloc modules in fresh interpreters and check
+that the dependencies that are slow to load and rarely needed are deferred:
+
+python -m hloc.benchmarks.imports
+
+The command fails if one of the modules imports a deferred dependency.
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import Dict, List
+
+from .. import logger
+
+default_modules = [
+    "hloc",
+    "hloc.extract_features",
+    "hloc.match_features",
+    "hloc.pairs_from_retrieval",
+    "hloc.utils.io",
+    "hloc.utils.parsers",
+]
+# Extractors and matchers are only imported by dynamic_load.
+deferred_modules = [
+    "pycolmap",
+    "gdown",
+    "sklearn",
+    "scipy.spatial",
+    "matplotlib",
+    "kornia",
+    "hloc.extractors.superpoint",
+    "hloc.matchers.lightglue",
+]
+
+
+def measure(module: str) -> Dict:
+    """Run `python -X importtime` and parse its report of the imported modules."""
+    cmd = [sys.executable, "-X", "importtime", "-c", f"import {module}"]
+    output = subprocess.run(cmd, stderr=subprocess.PIPE, text=True, check=True).stderr
+    cumulative = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, total, name = line.split("|")
+        cumulative[name.strip()] = int(total) / 1e6
+    imported = set(cumulative)
+    top = sorted(cumulative.items(), key=lambda x: -x[1])
+    return {
+        "module": module,
+        "seconds": cumulative[module],
+        "slowest": [(name, t) for name, t in top if name != module][:5],
+        "deferred_imported": [m for m in deferred_modules if m in imported],
+    }
+
+
+def main(modules: List[str] = default_modules) -> List[Dict]:
+    results = []
+    for module in modules:
+        result = measure(module)
+        logger.info(
+            "%s: %.3fs, slowest: %s",
+            module,
+            result["seconds"],
+            ", ".join(f"{name} {t:.3f}s" for name, t in result["slowest"]),
+        )
+        if result["deferred_imported"]:
+            logger.error(
+                f"{module} imports deferred modules: {result['deferred_imported']}."
+            )
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=str, nargs="+", default=default_modules)
+    args = parser.parse_args()
+    results = main(args.modules)
+    sys.exit(any(r["deferred_imported"] for r in results))
@@ -0,0 +1,97 @@
+"""
+Measure the matching throughput of a matcher against the number of pairs per
+batch, excluding the reading of the features, and check that the matches of
+each pair are identical to those obtained with one pair per batch, e.g.:
+
+python -m hloc.benchmarks.matching --conf NN-mutual \
+    --features outputs/feats-superpoint-n4096-r1024.h5 \
+    --pairs pairs/aachen/pairs-query-netvlad50.txt --batch_sizes 1 4 16 50
+"""
+
+import argparse
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+
+from .. import logger, match_features, matchers
+from ..utils.base_model import dynamic_load
+from ..utils.parsers import parse_retrieval
+
+
+@torch.no_grad()
+def main(
+    conf: Dict,
+    features: Path,
+    pairs: Path,
+    batch_sizes: List[int] = (1, 4, 16, 50),
+    num_pairs: int = 500,
+    device: str = "cpu",
+) -> List[Dict]:
+    pairs = [(q, r) for q, rs in parse_retrieval(pairs).items() for r in rs]
+    pairs = match_features.order_pairs(pairs[:num_pairs], "query")
+    model = dynamic_load(matchers, conf["model"]["name"])(conf["model"])
+    model = model.eval().to(device)
+    dataset = match_features.FeaturePairsDataset(pairs, features, features)
+    items = [dataset[i] for i in range(len(dataset))]
+    dataset.close()
+
+    results = []
+    reference = None
+    for batch_size in batch_sizes:
+        batches = match_features.split_in_batches(len(pairs), batch_size)
+        preds = {}
+        duration = 0
+        for indices in batches:
+            data = match_features.collate_pairs([items[i] for i in indices])
+            data = {k: v.to(device) for k, v in data.items()}
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+            preds.update(zip(indices, match_features.forward_pairs(model, data)))
+            if device == "cuda":
+                torch.cuda.synchronize()
+            duration += time.time() - start
+        matches = [preds.pop(i)["matches0"].cpu() for i in range(len(pairs))]
+        if reference is None:
+            reference = matches
+        identical = all(torch.equal(m, r) for m, r in zip(matches, reference))
+        results.append(
+            {
+                "batch_size": batch_size,
+                "pairs_per_sec": len(pairs) / duration,
+                "identical": identical,
+            }
+        )
+        logger.info(
+            "Batch size %d: %.1f pairs/sec%s",
+            batch_size,
+            len(pairs) / duration,
+            "" if identical else f", matches differ from batch size {batch_sizes[0]}",
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--conf",
+        type=str,
+        default="NN-mutual",
+        choices=list(match_features.confs.keys()),
+    )
+    parser.add_argument("--features", type=Path, required=True)
+    parser.add_argument("--pairs", type=Path, required=True)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16, 50])
+    parser.add_argument("--num_pairs", type=int, default=500)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+    main(
+        match_features.confs[args.conf],
+        args.features,
+        args.pairs,
+        args.batch_sizes,
+        args.num_pairs,
+        args.device,
+    )
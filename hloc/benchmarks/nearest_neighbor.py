@@ -0,0 +1,125 @@
+"""
+Compare the time and peak memory of the dense and chunked nearest neighbor
+matchers on random descriptors, with float32, float16 or int8 inputs, and check
+that their matches are identical. Ties between duplicate descriptors can be
+broken differently, so their matches are not compared:
+
+python -m hloc.benchmarks.nearest_neighbor --num_keypoints 8192 --chunk_sizes 512
+"""
+
+import argparse
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from .. import logger
+from ..matchers.nearest_neighbor import NearestNeighbor
+from ..utils.io import quantize
+from . import peak_rss_mb, run_in_process
+
+
+def random_descriptors(num: int, dim: int, dtype: str) -> Dict[str, torch.Tensor]:
+    rng = np.random.default_rng(0)
+    desc = [rng.normal(size=(dim, num)).astype(np.float32) for _ in range(2)]
+    # Half of the descriptors of image1 are noisy copies of those of image0.
+    desc[1][:, : num // 2] = desc[0][:, : num // 2] + 0.5 * desc[1][:, : num // 2]
+    data = {}
+    for i, d in enumerate(desc):
+        d /= np.linalg.norm(d, axis=0, keepdims=True)
+        # Duplicate keypoints, e.g. with several orientations, have identical
+        # descriptors, see `is_duplicate`.
+        d[:, 1::10] = d[:, : d[:, 1::10].shape[1] * 10 : 10]
+        if dtype == "int8":
+            d, data[f"descriptors_scale{i}"] = quantize(d)
+        elif dtype == "float16":
+            d = d.astype(np.float16)
+        data[f"descriptors{i}"] = d
+    return {k: torch.from_numpy(v)[None] for k, v in data.items()}
+
+
+def is_duplicate(num: int) -> np.ndarray:
+    """The descriptors of `random_descriptors` that have a duplicate."""
+    is_duplicate = np.arange(num) % 10 < 2
+    if num % 10 == 1:
+        is_duplicate[-1] = False
+    return is_duplicate
+
+
+@torch.no_grad()
+def measure(
+    conf: Dict, num: int, dim: int, dtype: str, chunk_size: Optional[int]
+) -> Dict:
+    data = random_descriptors(num, dim, dtype)
+    if chunk_size is None:
+        # The dense matcher takes float32 descriptors.
+        for i in "01":
+            data[f"descriptors{i}"] = data[f"descriptors{i}"].float()
+            if f"descriptors_scale{i}" in data:
+                scale = data.pop(f"descriptors_scale{i}")
+                data[f"descriptors{i}"] *= scale[:, None]
+    matcher = NearestNeighbor({**conf, "chunk_size": chunk_size})
+    matcher({k: v[..., :16] for k, v in data.items()})  # load the kernels
+    before = peak_rss_mb()
+    start = time.time()
+    pred = matcher(data)
+    duration = time.time() - start
+    return {
+        "seconds": duration,
+        "peak_mb": peak_rss_mb() - before,
+        "matches": pred["matches0"].numpy(),
+    }
+
+
+def main(
+    num_keypoints: int = 8192,
+    dim: int = 256,
+    chunk_sizes: List[int] = (512, 2048),
+    dtypes: List[str] = ("float32", "float16", "int8"),
+    conf: Dict = {"do_mutual_check": True, "ratio_threshold": 0.8},
+) -> List[Dict]:
+    results = []
+    for dtype in dtypes:
+        reference = None
+        for chunk_size in [None, *chunk_sizes]:
+            args = (conf, num_keypoints, dim, dtype, chunk_size)
+            result = run_in_process(measure, *args)
+            if "error" in result:
+                logger.error(f"{dtype}, chunk size {chunk_size}: {result['error']}")
+            else:
+                matches = result.pop("matches")[:, ~is_duplicate(num_keypoints)]
+                if chunk_size is None:
+                    reference = matches
+                elif reference is not None:
+                    result["identical"] = bool(np.array_equal(matches, reference))
+                logger.info(
+                    "%s, chunk size %s: %.2fs, peak of %.0fMB%s",
+                    dtype,
+                    chunk_size,
+                    result["seconds"],
+                    result["peak_mb"],
+                    (
+                        ", matches differ from the dense ones"
+                        if result.get("identical") is False
+                        else ""
+                    ),
+                )
+            results.append({"dtype": dtype, "chunk_size": chunk_size, **result})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_keypoints", type=int, default=8192)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[512, 2048])
+    parser.add_argument(
+        "--dtypes",
+        type=str,
+        nargs="+",
+        default=["float32", "float16", "int8"],
+        choices=["float32", "float16", "int8"],
+    )
+    args = parser.parse_args()
+    main(args.num_keypoints, args.dim, args.chunk_sizes, args.dtypes)
@@ -0,0 +1,103 @@
+"""
+Compare the time and peak memory of the NetVLAD aggregation when the residuals
+to the centers are materialized (original) and with the matrix product of the
+NetVLAD layer, for the VGG16 features of given image sizes, and check that the
+descriptors are identical up to rounding. The exit code is non-zero if they
+differ or if a run fails:
+
+python -m hloc.benchmarks.netvlad --sizes 480 1024 1600
+"""
+
+import argparse
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .. import logger
+from ..extractors.netvlad import NetVLADLayer
+from . import peak_rss_mb, run_in_process
+
+modes = ["residuals", "matmul"]
+
+
+def forward_residuals(layer: NetVLADLayer, x: torch.Tensor) -> torch.Tensor:
+    """The original aggregation, with the B x D x K x N residuals."""
+    scores = F.softmax(layer.score_proj(x), dim=1)
+    diff = x.unsqueeze(2) - layer.centers.unsqueeze(0).unsqueeze(-1)
+    desc = (scores.unsqueeze(1) * diff).sum(dim=-1)
+    if layer.intranorm:
+        desc = F.normalize(desc, dim=1)
+    return F.normalize(desc.view(x.size(0), -1), dim=1)
+
+
+@torch.no_grad()
+def measure(size: int, mode: str, dtype: str) -> Dict:
+    torch.manual_seed(0)
+    layer = NetVLADLayer().eval().to(getattr(torch, dtype))
+    # VGG16 features of stride 16 for a 4:3 image.
+    features = torch.rand(1, 512, size * 3 // 4 // 16 * (size // 16))
+    features = features.to(getattr(torch, dtype))
+    forward = layer if mode == "matmul" else lambda x: forward_residuals(layer, x)
+    forward(features[..., :16])  # load the kernels
+    before = peak_rss_mb()
+    start = time.time()
+    output = forward(features)
+    duration = time.time() - start
+    return {
+        "seconds": duration,
+        "peak_mb": peak_rss_mb() - before,
+        "output": output.numpy(),
+    }
+
+
+def main(
+    sizes: List[int] = (480, 1024, 1600),
+    dtype: str = "float32",
+    tolerance: float = 1e-6,
+) -> List[Dict]:
+    results = []
+    for size in sizes:
+        outputs = {}
+        for mode in modes:
+            result = run_in_process(measure, size, mode, dtype)
+            results.append({"size": size, "mode": mode, **result})
+            if "error" in result:
+                logger.error(f"{size}px {mode}: {result['error']}")
+                continue
+            outputs[mode] = results[-1].pop("output")
+            logger.info(
+                "%dpx %s: %.3fs, peak of %.1fMB above the inputs",
+                size,
+                mode,
+                result["seconds"],
+                result["peak_mb"],
+            )
+        if len(outputs) < len(modes):
+            continue
+        diff = np.abs(outputs["matmul"] - outputs["residuals"]).max()
+        results[-1]["max_difference"] = float(diff)
+        logger.info("%dpx: the descriptors differ by at most %.2g.", size, diff)
+        if not diff <= tolerance:
+            logger.error(f"The NetVLAD descriptors differ at {size}px.")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[480, 1024, 1600])
+    parser.add_argument(
+        "--dtype", type=str, default="float32", choices=["float32", "float64"]
+    )
+    parser.add_argument("--tolerance", type=float, default=1e-6)
+    args = parser.parse_args()
+    results = main(args.sizes, args.dtype, args.tolerance)
+    sys.exit(
+        any(
+            "error" in r or not r.get("max_difference", 0) <= args.tolerance
+            for r in results
+        )
+    )
@@ -0,0 +1,87 @@
+"""
+Compare the orders of the pairs in match_features by the hit rate of the
+feature cache and the amount of features read from the HDF5 files, with the
+pairs split over the DataLoader workers as in match_features, e.g.:
+
+python -m hloc.benchmarks.pair_order \
+    --features outputs/feats-superpoint-n4096-r1024.h5 \
+    --pairs outputs/pairs-netvlad.txt --cache_sizes 16777216 67108864
+"""
+
+import argparse
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from .. import logger, match_features
+from ..utils.parsers import parse_retrieval
+
+orders = ["none", "query", "greedy"]
+
+
+def main(
+    features: Path,
+    pairs: Path,
+    cache_sizes: List[int] = (16 * 2**20, 64 * 2**20),
+    num_workers: int = 5,
+    batch_size: int = 1,
+) -> List[Dict]:
+    pairs = [(q, r) for q, rs in parse_retrieval(pairs).items() for r in rs]
+    pairs = match_features.find_unique_new_pairs(pairs)
+    results = []
+    for cache_size in cache_sizes:
+        for order in orders:
+            ordered = match_features.order_pairs(pairs, order)
+            batches = match_features.split_in_batches(len(ordered), batch_size)
+            batches = match_features.interleave_for_workers(batches, num_workers)
+            # Hits, misses, bytes read and bytes requested, summed over workers.
+            totals = [0] * 4
+            start = time.time()
+            # The DataLoader hands the batches to the workers in turn, which
+            # then read contiguous runs of pairs, and each has its own cache.
+            for worker in range(num_workers):
+                dataset = match_features.FeaturePairsDataset(
+                    ordered, features, features, cache_size
+                )
+                for indices in batches[worker::num_workers]:
+                    for idx in indices:
+                        dataset[idx]
+                dataset.close()
+                totals = [t + s for t, s in zip(totals, dataset.stats[:])]
+            hits, misses, bytes_read, bytes_requested = totals
+            result = {
+                "order": order,
+                "cache_size": cache_size,
+                "seconds": time.time() - start,
+                "hit_rate": hits / (hits + misses),
+                "bytes_read": bytes_read,
+                "bytes_requested": bytes_requested,
+            }
+            results.append(result)
+            logger.info(
+                "%.0fMB cache, %s order: hit rate %.1f%%, read %.1fMB of %.1fMB, %.2fs",
+                cache_size / 2**20,
+                order,
+                100 * result["hit_rate"],
+                result["bytes_read"] / 1e6,
+                result["bytes_requested"] / 1e6,
+                result["seconds"],
+            )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features", type=Path, required=True)
+    parser.add_argument("--pairs", type=Path, required=True)
+    parser.add_argument(
+        "--cache_sizes",
+        type=int,
+        nargs="+",
+        default=[16 * 2**20, 64 * 2**20],
+        help="maximum sizes in bytes of the feature cache of each worker",
+    )
+    parser.add_argument("--num_workers", type=int, default=5)
+    parser.add_argument("--batch_size", type=int, default=1)
+    args = parser.parse_args()
+    main(args.features, args.pairs, args.cache_sizes, args.num_workers, args.batch_size)
@@ -0,0 +1,138 @@
+"""
+Check that the features extracted from uint8 images, which are normalized on
+the device (keep_uint8), match those extracted from float images. Keypoints
+match if they are within a given distance and the distances between their
+descriptors are averaged. The exit code is non-zero if too few keypoints match
+or if the descriptors are too far apart, e.g.:
+
+python -m hloc.benchmarks.preprocessing --image_dir datasets/sacre_coeur/mapping \
+    --confs superpoint_aachen sift netvlad --resize_max 1024
+"""
+
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import h5py
+import numpy as np
+from scipy.spatial import KDTree
+
+from .. import extract_features, logger
+from ..utils.io import list_h5_names, read_features
+
+
+def compare_features(path: Path, ref_path: Path, tolerance: float) -> Dict:
+    """Return the fraction of the reference keypoints with a keypoint within
+    `tolerance` pixels and the mean distance between their descriptors, or
+    between the global descriptors."""
+    num_keypoints = 0
+    distances = []
+    with h5py.File(str(path), "r") as fd, h5py.File(str(ref_path), "r") as fd_ref:
+        for name in list_h5_names(ref_path):
+            pred, ref = read_features(fd[name]), read_features(fd_ref[name])
+            if "keypoints" not in ref:
+                desc_diff = pred["global_descriptor"] - ref["global_descriptor"]
+                distances.append(np.linalg.norm(desc_diff, keepdims=True))
+                continue
+            num_keypoints += len(ref["keypoints"])
+            if len(pred["keypoints"]) == 0 or len(ref["keypoints"]) == 0:
+                continue
+            # Keypoints can have duplicates with other orientations, so those
+            # with the closest descriptor are compared.
+            neighbors = KDTree(pred["keypoints"]).query_ball_point(
+                ref["keypoints"], tolerance
+            )
+            for i, candidates in enumerate(neighbors):
+                if len(candidates) > 0:
+                    desc = pred["descriptors"][:, candidates]
+                    desc_diff = desc - ref["descriptors"][:, i : i + 1]
+                    distances.append(np.linalg.norm(desc_diff, axis=0).min()[None])
+    distances = np.concatenate(distances) if distances else np.zeros(0)
+    return {
+        "matched_keypoints": len(distances) / num_keypoints if num_keypoints else None,
+        "descriptor_distance": float(distances.mean()) if len(distances) else None,
+    }
+
+
+def main(
+    image_dir: Path,
+    confs: List[str] = ("superpoint_aachen", "sift", "netvlad"),
+    resize_max: Optional[int] = None,
+    tolerance: float = 0.5,
+    min_matched: float = 0.95,
+    max_distance: float = 0.05,
+) -> List[Dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in confs:
+            conf = extract_features.confs[name]
+            if resize_max is not None:
+                prep = {**conf["preprocessing"], "resize_max": resize_max}
+                conf = {**conf, "preprocessing": prep}
+            paths = {}
+            for keep_uint8 in (False, True):
+                prep = {**conf["preprocessing"], "keep_uint8": keep_uint8}
+                paths[keep_uint8] = Path(tmp_dir, f"{name}-{keep_uint8}.h5")
+                extract_features.main(
+                    {**conf, "preprocessing": prep},
+                    image_dir,
+                    feature_path=paths[keep_uint8],
+                    as_half=False,
+                )
+            result = {
+                "conf": name,
+                **compare_features(paths[True], paths[False], tolerance),
+            }
+            result["passed"] = (
+                result["matched_keypoints"] is None
+                or result["matched_keypoints"] >= min_matched
+            ) and (
+                result["descriptor_distance"] is not None
+                and result["descriptor_distance"] <= max_distance
+            )
+            results.append(result)
+            if result["matched_keypoints"] is not None:
+                logger.info(
+                    "%s: %.1f%% of the keypoints within %.1fpx, "
+                    "with descriptors at a mean distance of %.2g",
+                    name,
+                    100 * result["matched_keypoints"],
+                    tolerance,
+                    result["descriptor_distance"],
+                )
+            else:
+                logger.info(
+                    "%s: global descriptors at a mean distance of %.2g",
+                    name,
+                    result["descriptor_distance"],
+                )
+            if not result["passed"]:
+                logger.error(f"The {name} features differ with keep_uint8.")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", type=Path, required=True)
+    parser.add_argument(
+        "--confs",
+        type=str,
+        nargs="+",
+        default=["superpoint_aachen", "sift", "netvlad"],
+    )
+    parser.add_argument("--resize_max", type=int)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--min_matched", type=float, default=0.95)
+    parser.add_argument("--max_distance", type=float, default=0.05)
+    args = parser.parse_args()
+    results = main(
+        args.image_dir,
+        args.confs,
+        args.resize_max,
+        args.tolerance,
+        args.min_matched,
+        args.max_distance,
+    )
+    sys.exit(not all(r["passed"] for r in results))
@@ -0,0 +1,121 @@
+"""
+Compare the float and int8 quantized global descriptor models on CPU: extraction
+throughput and recall of the retrieved images w.r.t. a reference pair list,
+e.g. one generated with the float model:
+
+python -m hloc.benchmarks.quantization --conf netvlad \
+    --image_dir datasets/aachen/images/images_upright \
+    --pairs pairs/aachen/pairs-query-netvlad20.txt --mode static
+
+Queries are the first images of the pairs and the database the second ones.
+For each query, the top-k database images are retrieved, with k the number of
+its reference pairs. Images that are missing from `image_dir` are ignored.
+"""
+
+import argparse
+import tempfile
+import time
+from copy import deepcopy
+from pathlib import Path
+from typing import Dict, Optional
+
+import torch
+
+from .. import extract_features, logger
+from ..pairs_from_retrieval import get_descriptors
+from ..utils.parsers import parse_retrieval
+
+
+def retrieval_recall(
+    feature_path: Path, retrieval: Dict[str, list], db_names: list
+) -> float:
+    queries = list(retrieval)
+    scores = get_descriptors(queries, feature_path) @ (
+        get_descriptors(db_names, feature_path).T
+    )
+    recalls = []
+    for query, scores_q in zip(queries, scores):
+        k = min(len(retrieval[query]), len(db_names))
+        retrieved = {db_names[i] for i in torch.topk(scores_q, k).indices.tolist()}
+        recalls.append(len(retrieved & set(retrieval[query])) / k)
+    return sum(recalls) / len(recalls)
+
+
+def main(
+    conf: Dict,
+    image_dir: Path,
+    pairs: Path,
+    mode: str = "static",
+    calibration_dir: Optional[Path] = None,
+) -> Dict:
+    retrieval = parse_retrieval(pairs)
+    retrieval = {
+        q: [r for r in rs if (image_dir / r).exists()]
+        for q, rs in retrieval.items()
+        if (image_dir / q).exists()
+    }
+    retrieval = {q: rs for q, rs in retrieval.items() if len(rs) > 0}
+    if len(retrieval) == 0:
+        raise ValueError(f"Could not find the images of {pairs} in {image_dir}.")
+    db_names = sorted({r for rs in retrieval.values() for r in rs})
+    names = sorted(set(retrieval) | set(db_names))
+    logger.info(f"Using {len(retrieval)} queries and {len(db_names)} db images.")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for quantize in [None, mode]:
+            conf_q = deepcopy(conf)
+            conf_q["model"]["quantize"] = quantize
+            conf_q["model"]["calibration_images"] = calibration_dir or image_dir
+            model = extract_features.load_model(conf_q, "cpu")
+            dataset = extract_features.ImageDataset(
+                image_dir, conf_q["preprocessing"], names
+            )
+            feature_path = Path(tmp_dir, f"{quantize}.h5")
+            start = time.time()
+            extract_features.extract(model, dataset, feature_path, device="cpu")
+            duration = time.time() - start
+            results[quantize or "float"] = {
+                "images_per_sec": len(names) / duration,
+                "recall": retrieval_recall(feature_path, retrieval, db_names),
+            }
+            del model
+
+    float_, quant = results["float"], results[mode]
+    results["speedup"] = quant["images_per_sec"] / float_["images_per_sec"]
+    results["recall_change"] = quant["recall"] - float_["recall"]
+    logger.info(
+        "float: %.2f images/sec, recall %.4f; %s int8: %.2f images/sec, recall %.4f",
+        float_["images_per_sec"],
+        float_["recall"],
+        mode,
+        quant["images_per_sec"],
+        quant["recall"],
+    )
+    logger.info(
+        "Speedup x%.2f, recall change %+.4f.",
+        results["speedup"],
+        results["recall_change"],
+    )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--conf", type=str, default="netvlad", choices=["netvlad", "senet"]
+    )
+    parser.add_argument("--image_dir", type=Path, required=True)
+    parser.add_argument("--pairs", type=Path, required=True)
+    parser.add_argument(
+        "--mode", type=str, default="static", choices=["dynamic", "static"]
+    )
+    parser.add_argument("--calibration_dir", type=Path)
+    args = parser.parse_args()
+    main(
+        extract_features.confs[args.conf],
+        args.image_dir,
+        args.pairs,
+        args.mode,
+        args.calibration_dir,
+    )
@@ -0,0 +1,75 @@
+"""
+Compare the peak memory of the self-similarity module (SSM) of SENet when the
+correlation volume is built by unfolding the features (original), by shifted
+products, and by chunks of rows, for the feature maps of given image sizes, and
+check that the outputs are identical. The exit code is non-zero if they differ
+or if a run fails:
+
+python -m hloc.benchmarks.self_similarity --sizes 1024 1600
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from .. import logger
+from . import peak_rss_mb, run_in_process
+
+sys.path.append(str(Path(__file__).parent / "../.."))
+from third_party.SENet.model.self_similarity import SSM  # noqa: E402
+
+modes = ["unfold", "shifted", "chunked"]
+
+
+@torch.no_grad()
+def measure(size: int, mode: str, chunk_size: int) -> Dict:
+    torch.manual_seed(0)
+    ssm = SSM(in_ch=2048, mid_ch=256).eval()
+    if mode == "unfold":
+        ssm.SCC.forward = ssm.SCC.forward_unfold
+    ssm.chunk_size = chunk_size if mode == "chunked" else None
+    # ResNet features of stride 32 for a 4:3 image.
+    features = torch.rand(1, 2048, size * 3 // 4 // 32, size // 32)
+    before = peak_rss_mb()
+    output = ssm(features)
+    return {"peak_mb": peak_rss_mb() - before, "output": output.numpy()}
+
+
+def main(sizes: List[int] = (1024, 1600), chunk_size: int = 8) -> List[Dict]:
+    results = []
+    for size in sizes:
+        outputs = {}
+        for mode in modes:
+            result = run_in_process(measure, size, mode, chunk_size)
+            results.append({"size": size, "mode": mode, **result})
+            if "error" in result:
+                logger.error(f"{size}px {mode}: {result['error']}")
+                continue
+            outputs[mode] = results[-1].pop("output")
+            logger.info(
+                "%dpx %s: peak of %.1fMB above the inputs",
+                size,
+                mode,
+                result["peak_mb"],
+            )
+        if "unfold" not in outputs:
+            continue
+        for mode in [m for m in modes[1:] if m in outputs]:
+            identical = np.array_equal(outputs["unfold"], outputs[mode])
+            results[-len(modes) + modes.index(mode)]["identical"] = identical
+            if not identical:
+                logger.error(f"The {mode} SSM output differs at {size}px.")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 1600])
+    parser.add_argument("--chunk_size", type=int, default=8)
+    args = parser.parse_args()
+    results = main(args.sizes, args.chunk_size)
+    sys.exit(any("error" in r or r.get("identical") is False for r in results))
@@ -0,0 +1,73 @@
+"""
+Compare the per-query latency of the multi-scale SENet forward with that of the
+previous implementation, which moved the descriptor of each scale to the host
+before averaging them, e.g.:
+
+python -m hloc.benchmarks.senet --image_dir datasets/sacre_coeur/mapping
+"""
+
+import argparse
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .. import extract_features, logger
+
+
+def forward_legacy(model: torch.nn.Module, image: torch.Tensor) -> torch.Tensor:
+    descs = []
+    for scale in model.conf["scale_list"]:
+        _, _, height, width = image.shape
+        size = (int(height * scale), int(width * scale))
+        image_s = F.interpolate(image, size=size, mode="bilinear", align_corners=False)
+        desc = F.normalize(model.model(image_s), p=2, dim=1)
+        descs.append(desc.detach().cpu())
+    return F.normalize(torch.stack(descs).mean(0), p=2, dim=1)
+
+
+def forward_current(model: torch.nn.Module, image: torch.Tensor) -> torch.Tensor:
+    return model({"image": image})["global_descriptor"].cpu()
+
+
+@torch.no_grad()
+def main(
+    image_dir: Path, num_images: int = 10, conf: Dict = extract_features.confs["senet"]
+) -> Dict[str, List[float]]:
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = extract_features.load_model(conf, device)
+    dataset = extract_features.ImageDataset(image_dir, conf["preprocessing"])
+    dataset.names = dataset.names[:num_images]
+    images = [torch.from_numpy(dataset[i]["image"])[None] for i in range(len(dataset))]
+    forward_current(model, images[0].to(device))  # warm-up
+
+    latencies = {"legacy": [], "current": []}
+    for image in images:
+        descs = {}
+        for name, fn in [("legacy", forward_legacy), ("current", forward_current)]:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+            descs[name] = fn(model, image.to(device))
+            latencies[name].append(time.time() - start)
+        diff = (descs["legacy"] - descs["current"]).abs().max().item()
+        assert diff < 1e-5, diff
+    for name, times in latencies.items():
+        logger.info(
+            "%s: %.1fms per query (median over %d images)",
+            name,
+            1e3 * np.median(times),
+            len(times),
+        )
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", type=Path, required=True)
+    parser.add_argument("--num_images", type=int, default=10)
+    args = parser.parse_args()
+    main(args.image_dir, args.num_images)
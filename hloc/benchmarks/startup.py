@@ -0,0 +1,58 @@
+"""
+Measure the time-to-ready of the extractors, i.e. the time to import their
+module and load their weights, in fresh processes. The first load may download
+and convert the weights while the second one hits the cache, e.g.:
+
+python -m hloc.benchmarks.startup --confs netvlad dir eigenplaces
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from .. import extract_features, logger
+from . import run_in_process
+
+
+def time_to_ready(conf: Dict) -> Dict:
+    start = time.time()
+    extract_features.load_model(conf, "cpu")
+    return {"seconds": time.time() - start}
+
+
+def main(conf_names: List[str], num_runs: int = 2, output: Path = None) -> List[Dict]:
+    results = []
+    for name in conf_names:
+        for run in range(num_runs):
+            result = run_in_process(time_to_ready, extract_features.confs[name])
+            result = {"conf": name, "run": run, **result}
+            results.append(result)
+            if "error" in result:
+                logger.error(f"Could not load {name}: {result['error']}")
+                break
+            logger.info("%s run %d: ready in %.2fs", name, run, result["seconds"])
+
+    if output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        output.parent.mkdir(exist_ok=True, parents=True)
+        with open(str(output), "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--confs",
+        type=str,
+        nargs="+",
+        default=["netvlad", "dir", "eigenplaces"],
+        choices=list(extract_features.confs.keys()),
+    )
+    parser.add_argument("--num_runs", type=int, default=2)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+    main(args.confs, args.num_runs, args.output)
@@ -1,21 +1,36 @@
 import argparse
 import collections.abc as collections
 import glob
+import multiprocessing
+import os
 import pprint
+import sys
+import time
+from collections import defaultdict
+from contextlib import ExitStack
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import cv2
 import h5py
 import numpy as np
 import PIL.Image
 import torch
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm
 
 from . import extractors, logger
 from .utils.base_model import dynamic_load
-from .utils.io import list_h5_names, read_image
+from .utils.cache import FeatureCache
+from .utils.io import (
+    H5Writer,
+    get_image_size,
+    list_h5_names,
+    quantize,
+    read_image,
+    update_h5_names_index,
+)
 from .utils.parsers import parse_image_lists
 
 """
@@ -137,8 +152,12 @@ confs = {
     },
     "senet": {
         "output": "global-feats-senet",
-        "model": {"name": "senet", "model_name": "SENet_R50_con", 
-                  "resnet_size": 50, "scale_list": [0.7071, 1.0, 1.4142]},
+        "model": {
+            "name": "senet",
+            "model_name": "SENet_R50_con",
+            "resnet_size": 50,
+            "scale_list": [0.7071, 1.0, 1.4142],
+        },
         "preprocessing": {"resize_max": 1024},
     },
 }
@@ -161,6 +180,56 @@ def resize_image(image, size, interp):
     return resized
 
 
+def get_reduction_factor(size: int, conf: SimpleNamespace) -> int:
+    """Largest decoding reduction that keeps the image above its target size."""
+    if not (conf.reduced_decode and conf.resize_max) or size <= conf.resize_max:
+        return 1
+    for factor in (8, 4, 2):
+        if size // factor >= conf.resize_max:
+            return factor
+    return 1
+
+
+def preprocess_image(
+    image: np.ndarray, conf: SimpleNamespace, size: Optional[Tuple[int]] = None
+) -> np.ndarray:
+    """Resize and normalize an image. The target size is computed from the
+    original size if the image was decoded at a reduced resolution. With
+    keep_uint8, the image is not normalized and should be on the device."""
+    if not conf.keep_uint8:
+        image = image.astype(np.float32)
+    if size is None:
+        size = image.shape[:2][::-1]
+
+    if conf.resize_max and (conf.resize_force or max(size) > conf.resize_max):
+        scale = conf.resize_max / max(size)
+        size_new = tuple(int(round(x * scale)) for x in size)
+        image = resize_image(image, size_new, conf.interpolation)
+
+    if conf.grayscale:
+        image = image[None]
+    else:
+        image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
+    if not conf.keep_uint8:
+        image = image / 255.0
+    return image
+
+
+def normalize_image(image: torch.Tensor) -> torch.Tensor:
+    """Convert uint8 images to float in [0, 1], typically after the transfer."""
+    if image.dtype == torch.uint8:
+        image = image.float() / 255.0
+    return image
+
+
+def find_images(root: Path, globs: List[str]) -> List[str]:
+    paths = []
+    for g in globs:
+        paths += glob.glob((Path(root) / "**" / g).as_posix(), recursive=True)
+    paths = sorted(set(paths))
+    return [Path(p).relative_to(root).as_posix() for p in paths]
+
+
 class ImageDataset(torch.utils.data.Dataset):
     default_conf = {
         "globs": ["*.jpg", "*.png", "*.jpeg", "*.JPG", "*.PNG"],
@@ -168,6 +237,15 @@ class ImageDataset(torch.utils.data.Dataset):
         "resize_max": None,
         "resize_force": False,
         "interpolation": "cv2_area",  # pil_linear is more accurate but slower
+        # decode JPEG images at 1/2, 1/4 or 1/8 of their size when downsizing
+        "reduced_decode": False,
+        # keep uint8 images on the host and normalize them on the device
+        "keep_uint8": False,
+        # run local extractors on overlapping tiles of this size, see forward_tiled
+        "tile_size": None,
+        "tile_overlap": 32,
+        "tile_batch_size": 4,
+        "tile_nms_radius": 4,
     }
 
     def __init__(self, root, conf, paths=None):
@@ -175,13 +253,9 @@ class ImageDataset(torch.utils.data.Dataset):
         self.root = root
 
         if paths is None:
-            paths = []
-            for g in conf.globs:
-                paths += glob.glob((Path(root) / "**" / g).as_posix(), recursive=True)
-            if len(paths) == 0:
+            self.names = find_images(root, conf.globs)
+            if len(self.names) == 0:
                 raise ValueError(f"Could not find any image in root: {root}.")
-            paths = sorted(set(paths))
-            self.names = [Path(p).relative_to(root).as_posix() for p in paths]
             logger.info(f"Found {len(self.names)} images in root {root}.")
         else:
             if isinstance(paths, (Path, str)):
@@ -195,27 +269,30 @@ class ImageDataset(torch.utils.data.Dataset):
                 if not (root / name).exists():
                     raise ValueError(f"Image {name} does not exists in root: {root}.")
 
-    def __getitem__(self, idx):
-        name = self.names[idx]
-        image = read_image(self.root / name, self.conf.grayscale)
-        image = image.astype(np.float32)
-        size = image.shape[:2][::-1]
-
-        if self.conf.resize_max and (
-            self.conf.resize_force or max(size) > self.conf.resize_max
+    def read(self, name, grayscale, confs):
+        """Decode an image at the lowest resolution allowed by all the confs.
+        Return the image and its original size."""
+        path = self.root / name
+        factor = 1
+        if path.suffix.lower() in (".jpg", ".jpeg") and all(
+            conf.reduced_decode for conf in confs
         ):
-            scale = self.conf.resize_max / max(size)
-            size_new = tuple(int(round(x * scale)) for x in size)
-            image = resize_image(image, size_new, self.conf.interpolation)
-
-        if self.conf.grayscale:
-            image = image[None]
-        else:
-            image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
-        image = image / 255.0
+            size = get_image_size(path)
+            factor = min(get_reduction_factor(max(size), conf) for conf in confs)
+        image = read_image(path, grayscale, factor)
+        if factor == 1:
+            return image, image.shape[:2][::-1]
+        # The EXIF orientation applied by OpenCV can swap the width and height.
+        if (image.shape[0] > image.shape[1]) != (size[1] > size[0]):
+            size = size[::-1]
+        return image, size
 
+    def __getitem__(self, idx):
+        name = self.names[idx]
+        image, size = self.read(name, self.conf.grayscale, [self.conf])
         data = {
-            "image": image,
+            "name": name,
+            "image": preprocess_image(image, self.conf, size),
             "original_size": np.array(size),
         }
         return data
@@ -224,6 +301,413 @@ class ImageDataset(torch.utils.data.Dataset):
         return len(self.names)
 
 
+class MultiImageDataset(ImageDataset):
+    """Decode each image once and preprocess it for several configurations.
+    The image of the i-th configuration is stored under `image{i}`. Grayscale
+    images are converted from the decoded color image if any configuration
+    requires color, which can differ by a few intensity levels from decoding
+    them in grayscale directly.
+    """
+
+    def __init__(self, root, confs, paths=None):
+        super().__init__(root, confs[0], paths)
+        self.confs = [SimpleNamespace(**{**self.default_conf, **c}) for c in confs]
+
+    def __getitem__(self, idx):
+        name = self.names[idx]
+        grayscale = all(conf.grayscale for conf in self.confs)
+        image, size = self.read(name, grayscale, self.confs)
+        data = {"name": name, "original_size": np.array(size)}
+        for i, conf in enumerate(self.confs):
+            if conf.grayscale and not grayscale:
+                image_i = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+            else:
+                image_i = image
+            data[f"image{i}"] = preprocess_image(image_i, conf, size)
+        return data
+
+
+def collate_by_shape(items: List[Dict]) -> List[Dict]:
+    """Group the images of a batch by shape and stack each group separately."""
+    groups = defaultdict(list)
+    for item in items:
+        shape = tuple(v.shape for k, v in item.items() if k.startswith("image"))
+        groups[shape].append(item)
+    return [default_collate(group) for group in groups.values()]
+
+
+def forward_batch(model: torch.nn.Module, image: torch.Tensor) -> Dict:
+    """Run the model on a batch, one image at a time if it cannot batch."""
+    if model.supports_batching or len(image) == 1:
+        return model({"image": image})
+    preds = [model({"image": image[i : i + 1]}) for i in range(len(image))]
+    return {k: [p[k][0] for p in preds] for k in preds[0]}
+
+
+def get_tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    return starts + [length - tile_size]
+
+
+def get_tile_cuts(starts: List[int], tile_size: int, length: int) -> List[float]:
+    """Split the overlap of consecutive tiles at its center, such that each
+    point of the image belongs to exactly one tile."""
+    cuts = [(s0 + s1 + tile_size) / 2 for s0, s1 in zip(starts[:-1], starts[1:])]
+    return [0] + cuts + [length]
+
+
+def select_keypoints(pred: Dict, indices: torch.Tensor) -> Dict:
+    return {
+        k: v[..., indices] if k == "descriptors" else v[indices]
+        for k, v in pred.items()
+    }
+
+
+def suppress_seam_keypoints(
+    keypoints: np.ndarray,
+    scores: np.ndarray,
+    x_cuts: List[float],
+    y_cuts: List[float],
+    radius: float,
+) -> np.ndarray:
+    """Greedy radius NMS of the keypoints close to the borders between tiles,
+    which were detected independently in neighboring tiles."""
+    from scipy.spatial import KDTree
+
+    keep = np.ones(len(keypoints), bool)
+    dist_x = np.abs(keypoints[:, :1] - np.array(x_cuts[1:-1])[None])
+    dist_y = np.abs(keypoints[:, 1:] - np.array(y_cuts[1:-1])[None])
+    dist = np.concatenate([dist_x, dist_y, np.full((len(keypoints), 1), np.inf)], 1)
+    indices = np.where(dist.min(1) <= radius)[0]
+    if len(indices) == 0:
+        return keep
+    indices = indices[np.argsort(-scores[indices], kind="stable")]
+    neighbors = KDTree(keypoints[indices]).query_ball_point(keypoints[indices], radius)
+    for i, idx in enumerate(indices):
+        if keep[idx]:
+            suppressed = [indices[j] for j in neighbors[i] if j > i]
+            keep[suppressed] = False
+    return keep
+
+
+def forward_tiled(
+    model: torch.nn.Module,
+    image: torch.Tensor,
+    conf: SimpleNamespace,
+    device: str,
+) -> Dict[str, np.ndarray]:
+    """Run a local feature extractor on overlapping tiles of a single image.
+    The keypoints of each tile are kept only in its share of the overlaps,
+    duplicates across borders are removed by NMS, and only the global top-k
+    keypoints are kept after each batch of tiles, such that the memory does not
+    grow with the size of the image. Tiles are cropped from the host image, so
+    keep_uint8 further reduces the memory footprint of large images.
+    """
+    height, width = image.shape[-2:]
+    tile_size = conf.tile_size
+    xs = get_tile_starts(width, tile_size, conf.tile_overlap)
+    ys = get_tile_starts(height, tile_size, conf.tile_overlap)
+    x_cuts = get_tile_cuts(xs, tile_size, width)
+    y_cuts = get_tile_cuts(ys, tile_size, height)
+    tiles = [(i, j) for j in range(len(ys)) for i in range(len(xs))]
+    max_keypoints = model.conf.get("max_keypoints")
+
+    merged = None
+    for start in range(0, len(tiles), conf.tile_batch_size):
+        batch = tiles[start : start + conf.tile_batch_size]
+        crops = torch.stack(
+            [
+                image[..., ys[j] : ys[j] + tile_size, xs[i] : xs[i] + tile_size]
+                for i, j in batch
+            ]
+        )
+        pred = forward_batch(model, normalize_image(crops.to(device)))
+        if "keypoints" not in pred:
+            raise ValueError("Tiled extraction requires a local feature extractor.")
+        score_key = "scores" if "scores" in pred else "keypoint_scores"
+        for k, (i, j) in enumerate(batch):
+            pred_k = {key: v[k] for key, v in pred.items()}
+            pred_k["keypoints"] = pred_k["keypoints"] + pred_k["keypoints"].new_tensor(
+                [xs[i], ys[j]]
+            )
+            x, y = pred_k["keypoints"].unbind(-1)
+            valid = (x >= x_cuts[i]) & (x < x_cuts[i + 1])
+            valid &= (y >= y_cuts[j]) & (y < y_cuts[j + 1])
+            pred_k = select_keypoints(pred_k, torch.where(valid)[0])
+            if merged is not None:
+                pred_k = {
+                    key: torch.cat([merged[key], v], -1 if key == "descriptors" else 0)
+                    for key, v in pred_k.items()
+                }
+            merged = pred_k
+        del pred
+        if max_keypoints is not None and 0 < max_keypoints < len(merged[score_key]):
+            merged = select_keypoints(
+                merged, torch.topk(merged[score_key], max_keypoints).indices
+            )
+
+    merged = {k: v.cpu().numpy() for k, v in merged.items()}
+    keep = suppress_seam_keypoints(
+        merged["keypoints"], merged[score_key], x_cuts, y_cuts, conf.tile_nms_radius
+    )
+    return select_keypoints(merged, keep)
+
+
+def postprocess_features(
+    pred: Dict[str, np.ndarray],
+    size: np.ndarray,
+    original_size: np.ndarray,
+    detection_noise: float = 1,
+    as_half: bool = True,
+    quantize_descriptors: bool = False,
+) -> Tuple[Dict[str, np.ndarray], Optional[float]]:
+    """Bring the predictions of a resized image back to its original size."""
+    pred["image_size"] = original_size
+    uncertainty = None
+    if "keypoints" in pred:
+        scales = (original_size / size).astype(np.float32)
+        pred["keypoints"] = (pred["keypoints"] + 0.5) * scales[None] - 0.5
+        if "scales" in pred:
+            pred["scales"] *= scales.mean()
+        # add keypoint uncertainties scaled to the original resolution
+        uncertainty = detection_noise * scales.mean()
+
+    if as_half:
+        for k in pred:
+            dt = pred[k].dtype
+            if (dt == np.float32) and (dt != np.float16):
+                pred[k] = pred[k].astype(np.float16)
+
+    if quantize_descriptors and "descriptors" in pred:
+        pred["descriptors"], pred["descriptors_scale"] = quantize(pred["descriptors"])
+    return pred, uncertainty
+
+
+def write_features(fd: h5py.File, item: Tuple[str, Dict, Optional[float]]) -> str:
+    name, pred, uncertainty = item
+    try:
+        if name in fd:
+            del fd[name]
+        grp = fd.create_group(name)
+        for k, v in pred.items():
+            grp.create_dataset(k, data=v)
+        if "keypoints" in pred:
+            grp["keypoints"].attrs["uncertainty"] = uncertainty
+    except OSError as error:
+        if "No space left on device" in error.args[0]:
+            logger.error(
+                "Out of disk space: storing features on disk can take "
+                "significant space, did you enable the as_half flag?"
+            )
+            del grp, fd[name]
+        raise error
+    return name
+
+
+def runs_on_cpu_only(conf: Dict) -> bool:
+    """Models with an exported backend or quantized to int8 only run on the CPU."""
+    model_conf = conf["model"]
+    return (
+        model_conf.get("backend", "eager") != "eager"
+        or model_conf.get("quantize") is not None
+    )
+
+
+def select_device(*confs: Dict) -> str:
+    """Use the GPU if there is one, unless a model only runs on the CPU."""
+    if any(runs_on_cpu_only(conf) for conf in confs):
+        return "cpu"
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def load_model(conf: Dict, device: str) -> torch.nn.Module:
+    if runs_on_cpu_only(conf) and torch.device(device).type != "cpu":
+        raise ValueError(
+            f"Exported or quantized models only run on the CPU, not {device}."
+        )
+    Model = dynamic_load(extractors, conf["model"]["name"])
+    return Model(conf["model"]).eval().to(device)
+
+
+@torch.no_grad()
+def extract_multiple(
+    models: List[torch.nn.Module],
+    dataset: ImageDataset,
+    feature_paths: List[Path],
+    image_keys: List[str],
+    as_half: bool = True,
+    batch_size: int = 1,
+    device: str = "cpu",
+    quantize_descriptors: bool = False,
+    image_names: Optional[List[Set[str]]] = None,
+):
+    """Extract features for all images of a dataset and write them to disk.
+    Each model reads the images of its key and writes to its own file, only
+    for the images of its set in image_names if given.
+    Images are batched only with other images of the same size after resizing.
+    The features are written by background threads while the models run.
+    """
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=1,
+        shuffle=False,
+        pin_memory=True,
+        collate_fn=collate_by_shape,
+    )
+    confs = getattr(dataset, "confs", [dataset.conf])
+    with ExitStack() as stack:
+        writers = [
+            stack.enter_context(H5Writer(p, write_features)) for p in feature_paths
+        ]
+        pbar = stack.enter_context(tqdm(total=len(dataset)))
+        for groups in loader:
+            for data in groups:
+                for j, (model, key, writer, conf) in enumerate(
+                    zip(models, image_keys, writers, confs)
+                ):
+                    names, images = data["name"], data[key]
+                    original_sizes = data["original_size"]
+                    if image_names is not None:
+                        batch = [i for i, n in enumerate(names) if n in image_names[j]]
+                        if len(batch) == 0:
+                            continue
+                        if len(batch) < len(names):
+                            names = [names[i] for i in batch]
+                            images = images[batch]
+                            original_sizes = original_sizes[batch]
+                    detection_noise = getattr(model, "detection_noise", 1)
+                    size = np.array(images.shape[-2:][::-1])
+                    if conf.tile_size:
+                        preds = (forward_tiled(model, x, conf, device) for x in images)
+                    else:
+                        image = images.to(device, non_blocking=True)
+                        pred = forward_batch(model, normalize_image(image))
+                        preds = (
+                            {k: v[i].cpu().numpy() for k, v in pred.items()}
+                            for i in range(len(names))
+                        )
+                    for name, pred_i, original_size in zip(
+                        names, preds, original_sizes
+                    ):
+                        pred_i, uncertainty = postprocess_features(
+                            pred_i,
+                            size,
+                            original_size.numpy(),
+                            detection_noise,
+                            as_half,
+                            quantize_descriptors,
+                        )
+                        writer.put((name, pred_i, uncertainty))
+                    del preds
+                pbar.update(len(data["name"]))
+
+
+def extract(
+    model: torch.nn.Module,
+    dataset: ImageDataset,
+    feature_path: Path,
+    as_half: bool = True,
+    batch_size: int = 1,
+    device: str = "cpu",
+    quantize_descriptors: bool = False,
+):
+    extract_multiple(
+        [model],
+        dataset,
+        [feature_path],
+        ["image"],
+        as_half,
+        batch_size,
+        device,
+        quantize_descriptors,
+    )
+
+
+def extract_shard(
+    conf: Dict,
+    image_dir: Path,
+    names: List[str],
+    shard_path: Path,
+    as_half: bool,
+    batch_size: int,
+    num_threads: int,
+    quantize_descriptors: bool,
+):
+    torch.set_num_threads(num_threads)
+    dataset = ImageDataset(image_dir, conf["preprocessing"], names)
+    device = select_device(conf)
+    model = load_model(conf, device)
+    extract(
+        model, dataset, shard_path, as_half, batch_size, device, quantize_descriptors
+    )
+
+
+def merge_feature_files(shard_paths: List[Path], feature_path: Path):
+    """Copy the features of several files into a single one."""
+    with h5py.File(str(feature_path), "a", libver="latest") as fd:
+        for path in shard_paths:
+            names = list_h5_names(path)
+            with h5py.File(str(path), "r", libver="latest") as fd_shard:
+                for name in names:
+                    if name in fd:
+                        del fd[name]
+                    fd_shard.copy(fd_shard[name], fd, name=name)
+            update_h5_names_index(fd, names)
+
+
+def extract_sharded(
+    conf: Dict,
+    image_dir: Path,
+    names: List[str],
+    feature_path: Path,
+    as_half: bool = True,
+    batch_size: int = 1,
+    num_processes: int = 2,
+    quantize_descriptors: bool = False,
+):
+    """Split the images across processes that each run their own model and
+    write their own shard, then merge the shards into the feature file.
+    The processes are spawned, so scripts calling this need a main guard.
+    """
+    num_threads = max(1, (os.cpu_count() or 1) // num_processes)
+    shard_paths = [
+        feature_path.parent / f"{feature_path.stem}.shard{i}.h5"
+        for i in range(num_processes)
+    ]
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for i, shard_path in enumerate(shard_paths):
+        if shard_path.exists():
+            shard_path.unlink()
+        args = (
+            conf,
+            image_dir,
+            names[i::num_processes],
+            shard_path,
+            as_half,
+            batch_size,
+            num_threads,
+            quantize_descriptors,
+        )
+        processes.append(context.Process(target=extract_shard, args=args))
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [i for i, p in enumerate(processes) if p.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"Feature extraction failed for shards {failed}.")
+
+    shard_paths = [p for p in shard_paths if p.exists()]
+    logger.info(f"Merging {len(shard_paths)} shards into {feature_path}.")
+    merge_feature_files(shard_paths, feature_path)
+    for path in shard_paths:
+        path.unlink()
+
+
 @torch.no_grad()
 def main(
     conf: Dict,
@@ -233,6 +717,11 @@ def main(
     image_list: Optional[Union[Path, List[str]]] = None,
     feature_path: Optional[Path] = None,
     overwrite: bool = False,
+    batch_size: int = 1,
+    num_processes: int = 1,
+    cache_dir: Optional[Path] = None,
+    cache_size: Optional[int] = None,
+    quantize_descriptors: bool = False,
 ) -> Path:
     logger.info(
         "Extracting local features with configuration:" f"\n{pprint.pformat(conf)}"
@@ -246,59 +735,204 @@ def main(
         list_h5_names(feature_path) if feature_path.exists() and not overwrite else ()
     )
     dataset.names = [n for n in dataset.names if n not in skip_names]
+
+    # Reuse the features of images that were already extracted under any name.
+    if cache_dir is not None and len(dataset.names) > 0:
+        cache = FeatureCache(
+            cache_dir,
+            conf,
+            cache_size,
+            as_half=as_half,
+            quantize_descriptors=quantize_descriptors,
+        )
+        name2key = {n: cache.key(Path(image_dir, n)) for n in dataset.names}
+        hits = {n: k for n, k in name2key.items() if k in cache}
+        if len(hits) > 0:
+            logger.info(f"Loading {len(hits)} images from the feature cache.")
+            cache.load(feature_path, hits)
+        dataset.names = [n for n in dataset.names if n not in hits]
+    else:
+        cache = None
+
     if len(dataset.names) == 0:
         logger.info("Skipping the extraction.")
         return feature_path
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    Model = dynamic_load(extractors, conf["model"]["name"])
-    model = Model(conf["model"]).eval().to(device)
+    if num_processes > 1:
+        extract_sharded(
+            conf,
+            image_dir,
+            dataset.names,
+            feature_path,
+            as_half,
+            batch_size,
+            num_processes,
+            quantize_descriptors,
+        )
+    else:
+        device = select_device(conf)
+        model = load_model(conf, device)
+        extract(
+            model,
+            dataset,
+            feature_path,
+            as_half,
+            batch_size,
+            device,
+            quantize_descriptors,
+        )
 
-    loader = torch.utils.data.DataLoader(
-        dataset, num_workers=1, shuffle=False, pin_memory=True
+    if cache is not None:
+        cache.store(feature_path, {n: name2key[n] for n in dataset.names})
+        cache.evict()
+
+    logger.info("Finished exporting features.")
+    return feature_path
+
+
+@torch.no_grad()
+def main_multi(
+    confs: List[Dict],
+    image_dir: Path,
+    export_dir: Optional[Path] = None,
+    as_half: bool = True,
+    image_list: Optional[Union[Path, List[str]]] = None,
+    feature_paths: Optional[List[Path]] = None,
+    overwrite: bool = False,
+    batch_size: int = 1,
+    quantize_descriptors: bool = False,
+) -> List[Path]:
+    """Extract the features of several configurations, e.g. local features and
+    global descriptors, in a single pass that decodes each image only once.
+    Each configuration only extracts the images that are missing from its file.
+    """
+    logger.info(f"Extracting features with configurations:\n{pprint.pformat(confs)}")
+
+    dataset = MultiImageDataset(
+        image_dir, [c["preprocessing"] for c in confs], image_list
     )
-    for idx, data in enumerate(tqdm(loader)):
-        name = dataset.names[idx]
-        pred = model({"image": data["image"].to(device, non_blocking=True)})
-        pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
+    if feature_paths is None:
+        feature_paths = [Path(export_dir, c["output"] + ".h5") for c in confs]
+    missing_names = []
+    for path in feature_paths:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        skip_names = set(list_h5_names(path) if path.exists() and not overwrite else ())
+        missing_names.append(set(dataset.names) - skip_names)
+    indices = [i for i, names in enumerate(missing_names) if len(names) > 0]
+    if len(indices) == 0:
+        logger.info("Skipping the extraction.")
+        return feature_paths
+    names = set.union(*(missing_names[i] for i in indices))
+    dataset.names = [n for n in dataset.names if n in names]
+    dataset.confs = [dataset.confs[i] for i in indices]
 
-        pred["image_size"] = original_size = data["original_size"][0].numpy()
-        if "keypoints" in pred:
-            size = np.array(data["image"].shape[-2:][::-1])
-            scales = (original_size / size).astype(np.float32)
-            pred["keypoints"] = (pred["keypoints"] + 0.5) * scales[None] - 0.5
-            if "scales" in pred:
-                pred["scales"] *= scales.mean()
-            # add keypoint uncertainties scaled to the original resolution
-            uncertainty = getattr(model, "detection_noise", 1) * scales.mean()
-
-        if as_half:
-            for k in pred:
-                dt = pred[k].dtype
-                if (dt == np.float32) and (dt != np.float16):
-                    pred[k] = pred[k].astype(np.float16)
-
-        with h5py.File(str(feature_path), "a", libver="latest") as fd:
+    device = select_device(*(confs[i] for i in indices))
+    extract_multiple(
+        [load_model(confs[i], device) for i in indices],
+        dataset,
+        [feature_paths[i] for i in indices],
+        [f"image{j}" for j in range(len(indices))],
+        as_half,
+        batch_size,
+        device,
+        quantize_descriptors,
+        [missing_names[i] for i in indices],
+    )
+
+    logger.info("Finished exporting features.")
+    return feature_paths
+
+
+def watch(
+    conf: Dict,
+    image_dir: Path,
+    export_dir: Optional[Path] = None,
+    as_half: bool = True,
+    feature_path: Optional[Path] = None,
+    batch_size: int = 1,
+    interval: float = 5.0,
+    chunk_size: int = 256,
+    quantize_descriptors: bool = False,
+) -> Path:
+    """Keep the model loaded and extract the features of the images that are
+    added to or modified in `image_dir`, which is polled every `interval`
+    seconds. An image is processed once its size and modification time are
+    the same in two consecutive polls, so that partial copies are ignored.
+    Images that are already in the feature file at startup are skipped.
+    Stop with Ctrl-C.
+    """
+    if feature_path is None:
+        feature_path = Path(export_dir, conf["output"] + ".h5")
+    feature_path.parent.mkdir(exist_ok=True, parents=True)
+    prep_conf = SimpleNamespace(
+        **{**ImageDataset.default_conf, **conf["preprocessing"]}
+    )
+
+    def scan():
+        """The modification time and size of each image."""
+        states = {}
+        for name in find_images(image_dir, prep_conf.globs):
             try:
-                if name in fd:
-                    del fd[name]
-                grp = fd.create_group(name)
-                for k, v in pred.items():
-                    grp.create_dataset(k, data=v)
-                if "keypoints" in pred:
-                    grp["keypoints"].attrs["uncertainty"] = uncertainty
-            except OSError as error:
-                if "No space left on device" in error.args[0]:
-                    logger.error(
-                        "Out of disk space: storing features on disk can take "
-                        "significant space, did you enable the as_half flag?"
-                    )
-                    del grp, fd[name]
-                raise error
+                s = Path(image_dir, name).stat()
+            except FileNotFoundError:  # deleted since listed
+                continue
+            states[name] = s.st_mtime_ns, s.st_size
+        return states
 
-        del pred
+    done = {}  # the state of the images at the time of their extraction
+    if feature_path.exists():
+        existing = set(list_h5_names(feature_path))
+        done = {n: s for n, s in scan().items() if n in existing}
+    logger.info(f"Watching {image_dir} with {len(done)} images already extracted.")
 
-    logger.info("Finished exporting features.")
+    device = select_device(conf)
+    model = load_model(conf, device)
+    seen = {}  # the state of the new images at the previous poll
+    try:
+        while True:
+            ready = []
+            current = scan()
+            for name, state in current.items():
+                if done.get(name) == state:
+                    continue
+                if seen.get(name) == state:
+                    ready.append(name)
+            seen = current
+
+            for i in range(0, len(ready), chunk_size):
+                # Skip the images deleted since the poll, and fail like for
+                # unreadable images if some are deleted in the meantime.
+                names = ready[i : i + chunk_size]
+                names = [n for n in names if Path(image_dir, n).exists()]
+                if len(names) == 0:
+                    continue
+                start = time.time()
+                try:
+                    dataset = ImageDataset(image_dir, conf["preprocessing"], names)
+                    extract(
+                        model,
+                        dataset,
+                        feature_path,
+                        as_half,
+                        batch_size,
+                        device,
+                        quantize_descriptors,
+                    )
+                except Exception as error:
+                    # Retry only once the images have changed again.
+                    logger.error(f"Failed to extract {len(names)} images: {error}")
+                else:
+                    duration = time.time() - start
+                    queued = max(len(ready) - i - chunk_size, 0)
+                    logger.info(
+                        f"Extracted {len(names)} images at "
+                        f"{len(names) / duration:.2f} images/sec, "
+                        f"{queued} images in queue."
+                    )
+                done.update({n: current[n] for n in names})
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching.")
     return feature_path
 
 
@@ -312,5 +946,35 @@ if __name__ == "__main__":
     parser.add_argument("--as_half", action="store_true")
     parser.add_argument("--image_list", type=Path)
     parser.add_argument("--feature_path", type=Path)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_processes", type=int, default=1)
+    parser.add_argument("--cache_dir", type=Path)
+    parser.add_argument(
+        "--cache_size", type=int, help="maximum size in bytes of the whole cache_dir"
+    )
+    parser.add_argument("--quantize_descriptors", action="store_true")
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--interval", type=float, default=5.0)
     args = parser.parse_args()
-    main(confs[args.conf], args.image_dir, args.export_dir, args.as_half)
+    if args.watch:
+        watch(
+            confs[args.conf],
+            args.image_dir,
+            args.export_dir,
+            args.as_half,
+            batch_size=args.batch_size,
+            interval=args.interval,
+            quantize_descriptors=args.quantize_descriptors,
+        )
+        sys.exit()
+    main(
+        confs[args.conf],
+        args.image_dir,
+        args.export_dir,
+        args.as_half,
+        batch_size=args.batch_size,
+        num_processes=args.num_processes,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        quantize_descriptors=args.quantize_descriptors,
+    )
@@ -3,8 +3,6 @@ import sys
 from pathlib import Path
 from zipfile import ZipFile
 
-import gdown
-import sklearn
 import torch
 
 from ..utils.base_model import BaseModel
@@ -15,11 +13,16 @@ os.environ["DB_ROOT"] = ""  # required by dirtorch
 from dirtorch.extract_features import load_model  # noqa: E402
 from dirtorch.utils import common  # noqa: E402
 
-# The DIR model checkpoints (pickle files) include sklearn.decomposition.pca,
-# which has been deprecated in sklearn v0.24
-# and must be explicitly imported with `from sklearn.decomposition import PCA`.
-# This is a hacky workaround to maintain forward compatibility.
-sys.modules["sklearn.decomposition.pca"] = sklearn.decomposition._pca
+
+def patch_sklearn_pca():
+    # The DIR model checkpoints (pickle files) include sklearn.decomposition.pca,
+    # which has been deprecated in sklearn v0.24
+    # and must be explicitly imported with `from sklearn.decomposition import PCA`.
+    # This is a hacky workaround to maintain forward compatibility.
+    # sklearn is imported only here since it is slow to load.
+    import sklearn.decomposition
+
+    sys.modules["sklearn.decomposition.pca"] = sklearn.decomposition._pca
 
 
 class DIR(BaseModel):
@@ -41,8 +44,27 @@ class DIR(BaseModel):
     }
 
     def _init(self, conf):
+        patch_sklearn_pca()
+        # The network converted during a previous run is unpickled directly,
+        # which skips its construction and random initialization.
         checkpoint = Path(torch.hub.get_dir(), "dirtorch", conf["model_name"] + ".pt")
+        converted = checkpoint.with_name(conf["model_name"] + "-converted.pth")
+        if converted.exists():
+            self.net = torch.load(
+                str(converted), map_location="cpu", weights_only=False
+            )
+        else:
+            self.net = self.load_checkpoint(checkpoint, conf)
+            tmp_path = converted.with_suffix(f".{os.getpid()}.tmp")
+            torch.save(self.net, str(tmp_path))
+            os.replace(tmp_path, converted)
+        if conf["whiten_name"]:
+            assert conf["whiten_name"] in self.net.pca
+
+    def load_checkpoint(self, checkpoint, conf):
         if not checkpoint.exists():
+            import gdown
+
             checkpoint.parent.mkdir(exist_ok=True, parents=True)
             link = self.dir_models[conf["model_name"]]
             gdown.download(str(link), str(checkpoint) + ".zip", quiet=False)
@@ -50,10 +72,7 @@ class DIR(BaseModel):
             zf.extractall(checkpoint.parent)
             zf.close()
             os.remove(str(checkpoint) + ".zip")
-
-        self.net = load_model(checkpoint, False)  # first load on CPU
-        if conf["whiten_name"]:
-            assert conf["whiten_name"] in self.net.pca
+        return load_model(checkpoint, False)  # first load on CPU
 
     def _forward(self, data):
         image = data["image"]
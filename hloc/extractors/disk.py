@@ -12,6 +12,7 @@ class DISK(BaseModel):
         "pad_if_not_divisible": True,
     }
     required_inputs = ["image"]
+    supports_batching = True
 
     def _init(self, conf):
         self.model = kornia.feature.DISK.from_pretrained(conf["weights"])
@@ -1,3 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
 import kornia
 import numpy as np
 import pycolmap
@@ -16,6 +20,67 @@ def sift_to_rootsift(x):
     return x
 
 
+def create_sift(conf, use_gpu=False):
+    options = {**conf["options"]}
+    if conf["descriptor"] == "rootsift":
+        options["normalization"] = pycolmap.Normalization.L1_ROOT
+    else:
+        options["normalization"] = pycolmap.Normalization.L2
+    return pycolmap.Sift(
+        options=pycolmap.SiftExtractionOptions(options),
+        device=getattr(pycolmap.Device, "cuda" if use_gpu else "cpu"),
+    )
+
+
+# State of the worker processes, each with its own lazily created extractor.
+worker_conf = None
+worker_sift = None
+
+
+def init_worker(conf):
+    global worker_conf
+    worker_conf = conf
+
+
+def extract_in_worker(name, shape, index):
+    """Detect and describe the index-th image of a batch in shared memory.
+    Return the name of a new shared memory block holding the Nx4 keypoints
+    followed by the Nx128 descriptors, which the caller must unlink."""
+    global worker_sift
+    if worker_sift is None:
+        worker_sift = create_sift(worker_conf)
+    shm = SharedMemory(name=name)
+    image = np.ndarray(shape, np.float32, buffer=shm.buf)[index].copy()
+    shm.close()
+
+    keypoints, descriptors = worker_sift.extract(image)
+    keypoints = keypoints.astype(np.float32)
+    descriptors = descriptors.astype(np.float32)
+    out = SharedMemory(create=True, size=max(1, keypoints.nbytes + descriptors.nbytes))
+    out.buf[: keypoints.nbytes] = keypoints.tobytes()
+    out.buf[keypoints.nbytes : keypoints.nbytes + descriptors.nbytes] = (
+        descriptors.tobytes()
+    )
+    out.close()
+    return out.name, len(keypoints)
+
+
+def read_from_shared_memory(name, num_keypoints):
+    shm = SharedMemory(name=name)
+    try:
+        keypoints = np.ndarray((num_keypoints, 4), np.float32, buffer=shm.buf).copy()
+        descriptors = np.ndarray(
+            (num_keypoints, 128),
+            np.float32,
+            buffer=shm.buf,
+            offset=keypoints.nbytes,
+        ).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return keypoints, descriptors
+
+
 class DoG(BaseModel):
     default_conf = {
         "options": {
@@ -26,10 +91,13 @@ class DoG(BaseModel):
         "max_keypoints": -1,
         "patch_size": 32,
         "mr_size": 12,
+        # extract the images of a batch in parallel with a pool of processes
+        "num_workers": 0,
     }
     required_inputs = ["image"]
     detection_noise = 1.0
     max_batch_size = 1024
+    supports_batching = True
 
     def _init(self, conf):
         if conf["descriptor"] == "sosnet":
@@ -40,78 +108,106 @@ class DoG(BaseModel):
             raise ValueError(f'Unknown descriptor: {conf["descriptor"]}')
 
         self.sift = None  # lazily instantiated on the first image
+        self.pool = None
         self.dummy_param = torch.nn.Parameter(torch.empty(0))
 
+    def extract_sift(self, images):
+        """Run pycolmap on each image of a batch, in parallel if enabled."""
+        device = self.dummy_param.device
+        use_gpu = pycolmap.has_cuda and device.type == "cuda"
+        if self.conf["num_workers"] == 0 or use_gpu or len(images) == 1:
+            if self.sift is None:
+                self.sift = create_sift(self.conf, use_gpu)
+            return [self.sift.extract(image) for image in images]
+
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                self.conf["num_workers"],
+                mp_context=get_context("spawn"),
+                initializer=init_worker,
+                initargs=(self.conf,),
+            )
+        images = np.ascontiguousarray(images, dtype=np.float32)
+        shm = SharedMemory(create=True, size=images.nbytes)
+        try:
+            np.ndarray(images.shape, images.dtype, buffer=shm.buf)[:] = images
+            futures = [
+                self.pool.submit(extract_in_worker, shm.name, images.shape, i)
+                for i in range(len(images))
+            ]
+            return [read_from_shared_memory(*f.result()) for f in futures]
+        finally:
+            shm.close()
+            shm.unlink()
+
     def _forward(self, data):
         image = data["image"]
-        image_np = image.cpu().numpy()[0, 0]
+        image_np = image.cpu().numpy()[:, 0]
         assert image.shape[1] == 1
         assert image_np.min() >= -EPS and image_np.max() <= 1 + EPS
 
-        if self.sift is None:
-            device = self.dummy_param.device
-            use_gpu = pycolmap.has_cuda and device.type == "cuda"
-            options = {**self.conf["options"]}
-            if self.conf["descriptor"] == "rootsift":
-                options["normalization"] = pycolmap.Normalization.L1_ROOT
+        preds = []
+        patches = []
+        for i, (keypoints, descriptors) in enumerate(self.extract_sift(image_np)):
+            scales = keypoints[:, 2]
+            oris = np.rad2deg(keypoints[:, 3])
+
+            if self.conf["descriptor"] in ["sift", "rootsift"]:
+                # We still renormalize because COLMAP does not normalize well,
+                # maybe due to numerical errors
+                if self.conf["descriptor"] == "rootsift":
+                    descriptors = sift_to_rootsift(descriptors)
+                descriptors = torch.from_numpy(descriptors)
+            elif self.conf["descriptor"] in ("sosnet", "hardnet"):
+                center = keypoints[:, :2] + 0.5
+                laf_scale = scales * self.conf["mr_size"] / 2
+                laf_ori = -oris
+                lafs = laf_from_center_scale_ori(
+                    torch.from_numpy(center)[None],
+                    torch.from_numpy(laf_scale)[None, :, None, None],
+                    torch.from_numpy(laf_ori)[None, :, None],
+                ).to(image.device)
+                patches.append(
+                    extract_patches_from_pyramid(
+                        image[i : i + 1], lafs, PS=self.conf["patch_size"]
+                    )[0]
+                )
+                descriptors = None  # described below in a batch
             else:
-                options["normalization"] = pycolmap.Normalization.L2
-            self.sift = pycolmap.Sift(
-                options=pycolmap.SiftExtractionOptions(options),
-                device=getattr(pycolmap.Device, "cuda" if use_gpu else "cpu"),
-            )
+                raise ValueError(f'Unknown descriptor: {self.conf["descriptor"]}')
+
+            keypoints = torch.from_numpy(keypoints[:, :2])  # keep only x, y
+            scales = torch.from_numpy(scales)
+            oris = torch.from_numpy(oris)
+            scores = keypoints.new_zeros(len(keypoints))  # no scores for SIFT yet
+            preds.append([keypoints, scales, oris, scores, descriptors])
 
-        keypoints, descriptors = self.sift.extract(image_np)
-        scales = keypoints[:, 2]
-        oris = np.rad2deg(keypoints[:, 3])
-
-        if self.conf["descriptor"] in ["sift", "rootsift"]:
-            # We still renormalize because COLMAP does not normalize well,
-            # maybe due to numerical errors
-            if self.conf["descriptor"] == "rootsift":
-                descriptors = sift_to_rootsift(descriptors)
-            descriptors = torch.from_numpy(descriptors)
-        elif self.conf["descriptor"] in ("sosnet", "hardnet"):
-            center = keypoints[:, :2] + 0.5
-            laf_scale = scales * self.conf["mr_size"] / 2
-            laf_ori = -oris
-            lafs = laf_from_center_scale_ori(
-                torch.from_numpy(center)[None],
-                torch.from_numpy(laf_scale)[None, :, None, None],
-                torch.from_numpy(laf_ori)[None, :, None],
-            ).to(image.device)
-            patches = extract_patches_from_pyramid(
-                image, lafs, PS=self.conf["patch_size"]
-            )[0]
-            descriptors = patches.new_zeros((len(patches), 128))
-            if len(patches) > 0:
-                for start_idx in range(0, len(patches), self.max_batch_size):
-                    end_idx = min(len(patches), start_idx + self.max_batch_size)
-                    descriptors[start_idx:end_idx] = self.describe(
-                        patches[start_idx:end_idx]
-                    )
-        else:
-            raise ValueError(f'Unknown descriptor: {self.conf["descriptor"]}')
-
-        keypoints = torch.from_numpy(keypoints[:, :2])  # keep only x, y
-        scales = torch.from_numpy(scales)
-        oris = torch.from_numpy(oris)
-        scores = keypoints.new_zeros(len(keypoints))  # no scores for SIFT yet
+        if len(patches) > 0:
+            # Describe the patches of all images of the batch together.
+            all_patches = torch.cat(patches)
+            descriptors = all_patches.new_zeros((len(all_patches), 128))
+            for start_idx in range(0, len(all_patches), self.max_batch_size):
+                end_idx = min(len(all_patches), start_idx + self.max_batch_size)
+                descriptors[start_idx:end_idx] = self.describe(
+                    all_patches[start_idx:end_idx]
+                )
+            descriptors = descriptors.split([len(p) for p in patches])
+            for pred, desc in zip(preds, descriptors):
+                pred[-1] = desc
 
         if self.conf["max_keypoints"] != -1:
             # TODO: check that the scores from PyCOLMAP are 100% correct,
             # follow https://github.com/mihaidusmanu/pycolmap/issues/8
-            indices = torch.topk(scores, self.conf["max_keypoints"])
-            keypoints = keypoints[indices]
-            scales = scales[indices]
-            oris = oris[indices]
-            scores = scores[indices]
-            descriptors = descriptors[indices]
+            for pred in preds:
+                k = min(self.conf["max_keypoints"], len(pred[3]))
+                indices = torch.topk(pred[3], k).indices
+                pred[:] = [x[indices] for x in pred]
 
+        keypoints, scales, oris, scores, descriptors = zip(*preds)
         return {
-            "keypoints": keypoints[None],
-            "scales": scales[None],
-            "oris": oris[None],
-            "scores": scores[None],
-            "descriptors": descriptors.T[None],
+            "keypoints": list(keypoints),
+            "scales": list(scales),
+            "oris": list(oris),
+            "scores": list(scores),
+            "descriptors": [d.T for d in descriptors],
         }
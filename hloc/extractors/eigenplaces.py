@@ -23,6 +23,8 @@ EigenPlaces paper (ICCV 2023): https://arxiv.org/abs/2308.10832
 CosPlace paper (CVPR 2022): https://arxiv.org/abs/2204.02287
 """
 
+from pathlib import Path
+
 import torch
 import torchvision.transforms as tvf
 
@@ -36,11 +38,21 @@ class EigenPlaces(BaseModel):
         "fc_output_dim": 2048,
     }
     required_inputs = ["image"]
+    supports_batching = True
 
     def _init(self, conf):
+        # Load the repository from the hub cache if it was already downloaded,
+        # which skips the lookup of its latest version on GitHub.
+        repo, source = "gmberton/" + conf["variant"], "github"
+        repo_dirs = sorted(
+            Path(torch.hub.get_dir()).glob(f'gmberton_{conf["variant"]}_*')
+        )
+        if len(repo_dirs) > 0:
+            repo, source = str(repo_dirs[0]), "local"
         self.net = torch.hub.load(
-            "gmberton/" + conf["variant"],
+            repo,
             "get_trained_model",
+            source=source,
             backbone=conf["backbone"],
             fc_output_dim=conf["fc_output_dim"],
         ).eval()
@@ -1,4 +1,6 @@
 import logging
+import os
+from contextlib import nullcontext
 from pathlib import Path
 
 import numpy as np
@@ -6,9 +8,15 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.models as models
+from packaging import version
 from scipy.io import loadmat
 
 from ..utils.base_model import BaseModel
+from ..utils.quantization import (
+    load_calibration_images,
+    quantize_dynamic,
+    quantize_static,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -29,8 +37,10 @@ class NetVLADLayer(nn.Module):
         b = x.size(0)
         scores = self.score_proj(x)
         scores = F.softmax(scores, dim=1)
-        diff = x.unsqueeze(2) - self.centers.unsqueeze(0).unsqueeze(-1)
-        desc = (scores.unsqueeze(1) * diff).sum(dim=-1)
+        # sum_n a_kn (x_n - c_k) = sum_n a_kn x_n - c_k sum_n a_kn, which avoids
+        # materializing the B x D x K x N residuals.
+        desc = torch.bmm(x, scores.transpose(1, 2))
+        desc = desc - self.centers.unsqueeze(0) * scores.sum(dim=-1).unsqueeze(1)
         if self.intranorm:
             # From the official MATLAB implementation.
             desc = F.normalize(desc, dim=1)
@@ -40,8 +50,17 @@ class NetVLADLayer(nn.Module):
 
 
 class NetVLAD(BaseModel):
-    default_conf = {"model_name": "VGG16-NetVLAD-Pitts30K", "whiten": True}
+    default_conf = {
+        "model_name": "VGG16-NetVLAD-Pitts30K",
+        "whiten": True,
+        # None, "dynamic" (whitening only) or "static" (with the backbone)
+        "quantize": None,
+        "calibration_images": None,
+        "num_calibration_images": 16,
+    }
     required_inputs = ["image"]
+    supports_batching = True
+    exportable_modules = {"backbone": (1, 3, 480, 640), "netvlad": (1, 512, 1200)}
 
     # Models exported using
     # https://github.com/uzh-rpg/netvlad_tf_open/blob/master/matlab/net_class2struct.m.
@@ -56,6 +75,52 @@ class NetVLAD(BaseModel):
                 f'{conf["model_name"]} not in {self.checkpoint_urls.keys()}.'
             )
 
+        # Weights converted during a previous run are loaded directly. With
+        # torch>=2.1, the random initialization of the network is also skipped.
+        checkpoint_dir = Path(torch.hub.get_dir(), "netvlad")
+        suffix = "-whiten" if conf["whiten"] else ""
+        converted_path = checkpoint_dir / f'{conf["model_name"]}{suffix}.pth'
+        cached = converted_path.exists()
+        lazy = cached and version.parse(torch.__version__) >= version.parse("2.1")
+
+        with torch.device("meta") if lazy else nullcontext():
+            # Create the network.
+            # Remove classification head.
+            backbone = list(models.vgg16().children())[0]
+            # Remove last ReLU + MaxPool2d.
+            self.backbone = nn.Sequential(*list(backbone.children())[:-2])
+
+            self.netvlad = NetVLADLayer()
+
+            if conf["whiten"]:
+                self.whiten = nn.Linear(self.netvlad.output_dim, 4096)
+
+        if lazy:
+            converted = torch.load(str(converted_path), map_location="cpu", mmap=True)
+            self.load_state_dict(converted["state_dict"], assign=True)
+            mean = converted["mean"].numpy()
+        elif cached:
+            converted = torch.load(str(converted_path), map_location="cpu")
+            self.load_state_dict(converted["state_dict"])
+            mean = converted["mean"].numpy()
+        else:
+            mean = self.load_mat_weights(conf)
+            tmp_path = converted_path.with_suffix(f".{os.getpid()}.tmp")
+            state = {"state_dict": self.state_dict(), "mean": torch.from_numpy(mean)}
+            torch.save(state, str(tmp_path))
+            os.replace(tmp_path, converted_path)
+
+        # Preprocessing parameters.
+        self.preprocess = {
+            "mean": mean,
+            "std": np.array([1, 1, 1], dtype=np.float32),
+        }
+
+        if conf["quantize"] is not None:
+            self.quantize(conf)
+
+    def load_mat_weights(self, conf):
+        """Download and convert the MATLAB weights, return the mean image."""
         # Download the checkpoint.
         checkpoint_path = Path(
             torch.hub.get_dir(), "netvlad", conf["model_name"] + ".mat"
@@ -65,17 +130,6 @@ class NetVLAD(BaseModel):
             url = self.checkpoint_urls[conf["model_name"]]
             torch.hub.download_url_to_file(url, checkpoint_path)
 
-        # Create the network.
-        # Remove classification head.
-        backbone = list(models.vgg16().children())[0]
-        # Remove last ReLU + MaxPool2d.
-        self.backbone = nn.Sequential(*list(backbone.children())[:-2])
-
-        self.netvlad = NetVLADLayer()
-
-        if conf["whiten"]:
-            self.whiten = nn.Linear(self.netvlad.output_dim, 4096)
-
         # Parse MATLAB weights using https://github.com/uzh-rpg/netvlad_tf_open
         mat = loadmat(checkpoint_path, struct_as_record=False, squeeze_me=True)
 
@@ -117,11 +171,20 @@ class NetVLAD(BaseModel):
             self.whiten.weight = nn.Parameter(w)
             self.whiten.bias = nn.Parameter(b)
 
-        # Preprocessing parameters.
-        self.preprocess = {
-            "mean": mat["net"].meta.normalization.averageImage[0, 0],
-            "std": np.array([1, 1, 1], dtype=np.float32),
-        }
+        return mat["net"].meta.normalization.averageImage[0, 0]
+
+    def quantize(self, conf):
+        if conf["quantize"] not in ("dynamic", "static"):
+            raise ValueError(f'Unknown quantization mode {conf["quantize"]}.')
+        if conf["quantize"] == "static":
+            images = load_calibration_images(
+                conf["calibration_images"], conf["num_calibration_images"]
+            )
+            quantize_static(
+                self, ["backbone"], images, lambda x: self._forward({"image": x})
+            )
+        if conf["whiten"]:
+            quantize_dynamic(self, ["whiten"])
 
     def _forward(self, data):
         image = data["image"]
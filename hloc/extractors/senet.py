@@ -1,75 +1,86 @@
+import sys
+from pathlib import Path
+
 import torch
 import torch.nn.functional as F
-import cv2
-import numpy as np
-from pathlib import Path
 
 from ..utils.base_model import BaseModel
+from ..utils.quantization import (
+    load_calibration_images,
+    quantize_dynamic,
+    quantize_static,
+)
 
-import third_party.SENet.core.checkpoint as checkpoint
-from third_party.SENet.model.SENet_model import SENet as OriginalSENet
+sys.path.append(str(Path(__file__).parent / "../.."))
+import third_party.SENet.core.checkpoint as checkpoint  # noqa: E402
+from third_party.SENet.model.SENet_model import SENet as OriginalSENet  # noqa: E402
 
 
 class SENet(BaseModel):
-
-    checkpoint_urls = {"SENet_R50_con": "https://data.ciirc.cvut.cz/public/projects/2020ARTwin/models/senet_weights/SENet_R50_con.pyth"}
-
-    def _init(self, config, device=None):
-        if config["model_name"] not in self.checkpoint_urls:
+    default_conf = {
+        "model_name": "SENet_R50_con",
+        "resnet_size": 50,
+        "scale_list": [0.7071, 1.0, 1.4142],
+        # rows of the self-similarity volume processed at once, None for all
+        "ssm_chunk_size": 8,
+        # defaults to the torch hub directory
+        "checkpoint_dir": None,
+        # None, "dynamic" (final projection only) or "static" (with the ResNet)
+        "quantize": None,
+        "calibration_images": None,
+        "num_calibration_images": 16,
+    }
+    required_inputs = ["image"]
+    supports_batching = True
+
+    checkpoint_urls = {
+        "SENet_R50_con": "https://data.ciirc.cvut.cz/public/projects/2020ARTwin/models/senet_weights/SENet_R50_con.pyth",  # noqa: E501
+    }
+
+    def _init(self, conf):
+        if conf["model_name"] not in self.checkpoint_urls:
             raise ValueError(
-                f'{config["model_name"]} not in {self.checkpoint_urls.keys()}.'
-            )    
-        checkpoint_path = Path("/app/third_party/SENet/weights") / (config["model_name"] + ".pyth")
+                f'{conf["model_name"]} not in {self.checkpoint_urls.keys()}.'
+            )
+
+        # Download the checkpoint.
+        checkpoint_dir = conf["checkpoint_dir"] or Path(torch.hub.get_dir(), "senet")
+        checkpoint_path = Path(checkpoint_dir, conf["model_name"] + ".pyth")
         if not checkpoint_path.exists():
             checkpoint_path.parent.mkdir(exist_ok=True, parents=True)
-            url = self.checkpoint_urls[config["model_name"]]
+            url = self.checkpoint_urls[conf["model_name"]]
             torch.hub.download_url_to_file(url, checkpoint_path)
 
-        self.model = OriginalSENet(config['resnet_size'])
-        self.device = device
-        self.config = config
-        self.scale_list = config['scale_list']
+        self.model = OriginalSENet(conf["resnet_size"])
         checkpoint.load_checkpoint(str(checkpoint_path), self.model)
-
-    def to(self, device):
-        self.model = self.model.to(device)
-        return self
-
-    def eval(self):
-        self.model.eval()
-        return self
+        self.model.SSM.chunk_size = conf["ssm_chunk_size"]
+
+        if conf["quantize"] is not None:
+            self.quantize(conf)
+
+    def quantize(self, conf):
+        if conf["quantize"] not in ("dynamic", "static"):
+            raise ValueError(f'Unknown quantization mode {conf["quantize"]}.')
+        if conf["quantize"] == "static":
+            images = load_calibration_images(
+                conf["calibration_images"], conf["num_calibration_images"]
+            )
+            stages = ["model.stem", "model.s1", "model.s2", "model.s3", "model.s4"]
+            quantize_static(self, stages, images, self.model)
+        quantize_dynamic(self, ["model.head"])
 
     def _forward(self, data):
-        image = data['image']
-        img_feats = [[] for _ in self.scale_list]
-
-        for idx, scale in enumerate(self.scale_list):
-            _, _, height, width = image.shape
-            new_height = int(height * scale)
-            new_width = int(width * scale)
-            image_tensor = F.interpolate(image, size=(new_height, new_width), mode='bilinear', align_corners=False)
-
-            with torch.no_grad():
-                desc = self.model(image_tensor)
-
-            if len(desc.shape) == 1:
-                desc.unsqueeze_(0)
-            desc = F.normalize(desc, p=2, dim=1)
-            img_feats[idx].append(desc.detach().cpu())
-
-        # Aggregate across scales
-        for idx in range(len(img_feats)):
-            img_feats[idx] = torch.cat(img_feats[idx], dim=0)
-            if len(img_feats[idx].shape) == 1:
-                img_feats[idx].unsqueeze_(0)
-
-        img_feats_agg = F.normalize(
-            torch.mean(
-                torch.cat([img_feat.unsqueeze(0) for img_feat in img_feats], dim=0),
-                dim=0,
-            ),
-            p=2,
-            dim=1,
-        )
-        return {"global_descriptor": img_feats_agg}
-
+        image = data["image"]
+        height, width = image.shape[-2:]
+
+        # All images of the batch are processed together at each scale and
+        # the descriptors are averaged on the device.
+        desc = 0
+        for scale in self.conf["scale_list"]:
+            size = (int(height * scale), int(width * scale))
+            image_s = F.interpolate(
+                image, size=size, mode="bilinear", align_corners=False
+            )
+            desc = desc + F.normalize(self.model(image_s), p=2, dim=1)
+        desc = F.normalize(desc / len(self.conf["scale_list"]), p=2, dim=1)
+        return {"global_descriptor": desc}
@@ -25,6 +25,36 @@ def sample_descriptors_fix_sampling(keypoints, descriptors, s: int = 8):
     return descriptors
 
 
+class DenseSuperPoint(torch.nn.Module):
+    """The convolutional part of SuperPoint, which can be exported. It returns
+    the dense keypoint scores and the normalized descriptor map."""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, image):
+        net = self.net
+        x = net.relu(net.conv1a(image))
+        x = net.pool(net.relu(net.conv1b(x)))
+        x = net.relu(net.conv2a(x))
+        x = net.pool(net.relu(net.conv2b(x)))
+        x = net.relu(net.conv3a(x))
+        x = net.pool(net.relu(net.conv3b(x)))
+        x = net.relu(net.conv4a(x))
+        x = net.relu(net.conv4b(x))
+
+        scores = net.convPb(net.relu(net.convPa(x)))
+        scores = torch.nn.functional.softmax(scores, 1)[:, :-1]
+        b, _, h, w = scores.shape
+        scores = scores.permute(0, 2, 3, 1).reshape(b, h, w, 8, 8)
+        scores = scores.permute(0, 1, 3, 2, 4).reshape(b, h * 8, w * 8)
+
+        descriptors = net.convDb(net.relu(net.convDa(x)))
+        descriptors = torch.nn.functional.normalize(descriptors, p=2, dim=1)
+        return scores, descriptors
+
+
 class SuperPoint(BaseModel):
     default_conf = {
         "nms_radius": 4,
@@ -35,11 +65,47 @@ class SuperPoint(BaseModel):
     }
     required_inputs = ["image"]
     detection_noise = 2.0
+    supports_batching = True
+    exportable_modules = {"dense": (1, 1, 480, 640)}
 
     def _init(self, conf):
         if conf["fix_sampling"]:
             superpoint.sample_descriptors = sample_descriptors_fix_sampling
         self.net = superpoint.SuperPoint(conf)
+        if conf.get("backend", "eager") != "eager":
+            self.dense = DenseSuperPoint(self.net)
 
     def _forward(self, data):
-        return self.net(data)
+        if not hasattr(self, "dense"):
+            return self.net(data)
+
+        # Same as SuperPoint.forward but with the exported dense network.
+        scores, descriptors = self.dense(data["image"])
+        conf = self.net.config
+        h, w = scores.shape[-2:]
+        scores = superpoint.simple_nms(scores, conf["nms_radius"])
+        keypoints = [torch.nonzero(s > conf["keypoint_threshold"]) for s in scores]
+        scores = [s[tuple(k.t())] for s, k in zip(scores, keypoints)]
+        keypoints, scores = list(
+            zip(
+                *[
+                    superpoint.remove_borders(k, s, conf["remove_borders"], h, w)
+                    for k, s in zip(keypoints, scores)
+                ]
+            )
+        )
+        if conf["max_keypoints"] >= 0:
+            keypoints, scores = list(
+                zip(
+                    *[
+                        superpoint.top_k_keypoints(k, s, conf["max_keypoints"])
+                        for k, s in zip(keypoints, scores)
+                    ]
+                )
+            )
+        keypoints = [torch.flip(k, [1]).float() for k in keypoints]
+        descriptors = [
+            superpoint.sample_descriptors(k[None], d[None], 8)[0]
+            for k, d in zip(keypoints, descriptors)
+        ]
+        return {"keypoints": keypoints, "scores": scores, "descriptors": descriptors}
@@ -14,10 +14,10 @@ from scipy.spatial import KDTree
 from tqdm import tqdm
 
 from . import logger, matchers
-from .extract_features import read_image, resize_image
+from .extract_features import normalize_image, read_image, resize_image
 from .match_features import find_unique_new_pairs
 from .utils.base_model import dynamic_load
-from .utils.io import list_h5_names
+from .utils.io import list_h5_names, update_h5_names_index
 from .utils.parsers import names_to_pair, parse_retrieval
 
 # Default usage:
@@ -167,6 +167,8 @@ class ImagePairDataset(torch.utils.data.Dataset):
         "resize_max": 1024,
         "dfactor": 8,
         "cache_images": False,
+        # keep uint8 images on the host and normalize them on the device
+        "keep_uint8": False,
     }
 
     def __init__(self, image_dir, conf, pairs):
@@ -183,7 +185,8 @@ class ImagePairDataset(torch.utils.data.Dataset):
                 self.images[name], self.scales[name] = self.preprocess(image)
 
     def preprocess(self, image: np.ndarray):
-        image = image.astype(np.float32, copy=False)
+        if not self.conf.keep_uint8:
+            image = image.astype(np.float32, copy=False)
         size = image.shape[:2][::-1]
         scale = np.array([1.0, 1.0])
 
@@ -199,7 +202,10 @@ class ImagePairDataset(torch.utils.data.Dataset):
             image = image[None]
         else:
             image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
-        image = torch.from_numpy(image / 255.0).float()
+        if self.conf.keep_uint8:
+            image = torch.from_numpy(np.ascontiguousarray(image))
+        else:
+            image = torch.from_numpy(image / 255.0).float()
 
         # assure that the size is divisible by dfactor
         size_new = tuple(
@@ -251,7 +257,8 @@ def match_dense(
             # load image-pair data
             image0, image1, scale0, scale1, (name0,), (name1,) = data
             scale0, scale1 = scale0[0].numpy(), scale1[0].numpy()
-            image0, image1 = image0.to(device), image1.to(device)
+            image0 = normalize_image(image0.to(device))
+            image1 = normalize_image(image1.to(device))
 
             # match semi-dense
             # for consistency with pairs_from_*: refine kpts of image0
@@ -357,6 +364,7 @@ def aggregate_matches(
     if len(required_queries) > 0:
         logger.info(f"Aggregating keypoints for {len(required_queries)} images.")
     n_kps = 0
+    written = []
     with h5py.File(str(match_path), "a") as fd:
         for name0, name1 in tqdm(pairs, smoothing=0.1):
             pair = names_to_pair(name0, name1)
@@ -428,8 +436,13 @@ def aggregate_matches(
                     kgrp.create_dataset("keypoints", data=cpdict[name])
                     kgrp.create_dataset("score", data=kp_score)
                     n_kps += cpdict[name].shape[0]
+                written.append(name)
                 del bindict[name]
 
+    if len(written) > 0:
+        with h5py.File(feature_path, "a", libver="latest") as kfd:
+            update_h5_names_index(kfd, written)
+
     if len(required_queries) > 0:
         avg_kp_per_image = round(n_kps / len(required_queries), 1)
         logger.info(
@@ -1,17 +1,19 @@
 import argparse
+import heapq
+import multiprocessing
 import pprint
-from functools import partial
+from collections import OrderedDict, defaultdict
 from pathlib import Path
-from queue import Queue
-from threading import Thread
 from typing import Dict, List, Optional, Tuple, Union
 
 import h5py
+import numpy as np
 import torch
 from tqdm import tqdm
 
 from . import logger, matchers
 from .utils.base_model import dynamic_load
+from .utils.io import H5Writer, dequantize_features
 from .utils.parsers import names_to_pair, names_to_pair_old, parse_retrieval
 
 """
@@ -81,68 +83,237 @@ confs = {
 }
 
 
-class WorkQueue:
-    def __init__(self, work_fn, num_threads=1):
-        self.queue = Queue(num_threads)
-        self.threads = [
-            Thread(target=self.thread_fn, args=(work_fn,)) for _ in range(num_threads)
-        ]
-        for thread in self.threads:
-            thread.start()
-
-    def join(self):
-        for thread in self.threads:
-            self.queue.put(None)
-        for thread in self.threads:
-            thread.join()
-
-    def thread_fn(self, work_fn):
-        item = self.queue.get()
-        while item is not None:
-            work_fn(item)
-            item = self.queue.get()
-
-    def put(self, data):
-        self.queue.put(data)
-
-
 class FeaturePairsDataset(torch.utils.data.Dataset):
-    def __init__(self, pairs, feature_path_q, feature_path_r):
+    def __init__(self, pairs, feature_path_q, feature_path_r, cache_size=64 * 2**20):
         self.pairs = pairs
         self.feature_path_q = feature_path_q
         self.feature_path_r = feature_path_r
+        self.cache_size = cache_size  # maximum size in bytes, per worker
+        # Opened lazily such that each DataLoader worker has its own handles.
+        self.handles = {}
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        # Hits, misses, bytes read from the files and bytes requested, which
+        # are shared by the DataLoader workers.
+        self.stats = multiprocessing.Array("q", 4)
+
+    def __getstate__(self):
+        state = {**self.__dict__, "handles": {}, "cache": OrderedDict()}
+        return {**state, "cached_bytes": 0}
+
+    def read(self, path, name):
+        """Read the features of an image, with a LRU cache of the last images.
+        The cache holds the features as stored, e.g. in half precision, and is
+        bounded by cache_size bytes. They are converted to float when returned.
+        """
+        key = (str(path), name)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            features, nbytes = self.cache[key]
+            self.record(True, nbytes)
+        else:
+            if key[0] not in self.handles:
+                self.handles[key[0]] = h5py.File(key[0], "r")
+            features = {k: v.__array__() for k, v in self.handles[key[0]][name].items()}
+            nbytes = sum(v.nbytes for v in features.values())
+            self.record(False, nbytes)
+            if nbytes <= self.cache_size:
+                self.cache[key] = (features, nbytes)
+                self.cached_bytes += nbytes
+                while self.cached_bytes > self.cache_size:
+                    self.cached_bytes -= self.cache.popitem(last=False)[1][1]
+        features = dequantize_features(features)
+        return {k: torch.from_numpy(v).float() for k, v in features.items()}
+
+    def record(self, hit: bool, nbytes: int):
+        with self.stats.get_lock():
+            self.stats[0 if hit else 1] += 1
+            self.stats[2] += 0 if hit else nbytes
+            self.stats[3] += nbytes
+
+    def cache_stats(self) -> Dict[str, float]:
+        hits, misses, bytes_read, bytes_requested = self.stats[:]
+        return {
+            "hit_rate": hits / max(hits + misses, 1),
+            "bytes_read": bytes_read,
+            "bytes_requested": bytes_requested,
+        }
 
     def __getitem__(self, idx):
         name0, name1 = self.pairs[idx]
+        # The image sizes are passed as metadata (image_size0/1), not as images.
         data = {}
-        with h5py.File(self.feature_path_q, "r") as fd:
-            grp = fd[name0]
-            for k, v in grp.items():
-                data[k + "0"] = torch.from_numpy(v.__array__()).float()
-            # some matchers might expect an image but only use its size
-            data["image0"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
-        with h5py.File(self.feature_path_r, "r") as fd:
-            grp = fd[name1]
-            for k, v in grp.items():
-                data[k + "1"] = torch.from_numpy(v.__array__()).float()
-            data["image1"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
+        for k, v in self.read(self.feature_path_q, name0).items():
+            data[k + "0"] = v
+        for k, v in self.read(self.feature_path_r, name1).items():
+            data[k + "1"] = v
         return data
 
     def __len__(self):
         return len(self.pairs)
 
+    def close(self):
+        for fd in self.handles.values():
+            fd.close()
+        self.handles = {}
+        self.cache.clear()
+        self.cached_bytes = 0
+
+
+def add_image_placeholders(data: Dict[str, torch.Tensor]):
+    """Some matchers expect an image but only use its size: add Bx1xHxW tensors
+    that are expanded from a single element and thus take no memory."""
+    for i in "01":
+        if f"image{i}" not in data and f"image_size{i}" in data:
+            size = data[f"image_size{i}"]
+            w, h = size.max(0).values.long().tolist()
+            data[f"image{i}"] = size.new_empty(()).expand(len(size), 1, h, w)
+    return data
+
+
+def pad_to_length(x: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    shape = list(x.shape)
+    shape[dim] = length - x.shape[dim]
+    return torch.cat([x, x.new_zeros(shape)], dim)
+
+
+def collate_pairs(items: List[Dict]) -> Dict[str, torch.Tensor]:
+    """Stack the features of several pairs. The keypoints of each side are
+    padded to the largest number in the batch and mask0/1 are the valid ones."""
+    data = {}
+    for i in "01":
+        sizes = torch.tensor([item[f"descriptors{i}"].shape[-1] for item in items])
+        data[f"mask{i}"] = torch.arange(sizes.max())[None] < sizes[:, None]
+    for k in items[0]:
+        if k.startswith("image_size"):
+            data[k] = torch.stack([item[k] for item in items])
+            continue
+        length = data[f"mask{k[-1]}"].shape[1]
+        dim = -1 if k.startswith("descriptors") else 0
+        data[k] = torch.stack([pad_to_length(item[k], length, dim) for item in items])
+    return data
+
+
+def select_pair(data: Dict[str, torch.Tensor], b: int) -> Dict[str, torch.Tensor]:
+    """Extract the b-th pair of a padded batch, without the padding."""
+    pair = {}
+    for k, v in data.items():
+        if k.startswith("mask"):
+            continue
+        if k.startswith("image_size"):
+            pair[k] = v[b : b + 1]
+            continue
+        num = int(data[f"mask{k[-1]}"][b].sum())
+        if k.startswith("descriptors"):
+            pair[k] = v[b : b + 1, :, :num]
+        else:
+            pair[k] = v[b : b + 1, :num]
+    return pair
+
+
+def forward_pairs(model: torch.nn.Module, data: Dict) -> List[Dict]:
+    """Run the matcher on a padded batch of pairs, or on one pair at a time if
+    it does not support batching, and return the prediction of each pair."""
+    if not model.supports_batching or len(data["mask0"]) == 1:
+        pairs = [select_pair(data, b) for b in range(len(data["mask0"]))]
+        return [model(add_image_placeholders(pair)) for pair in pairs]
+    pred = model(add_image_placeholders(data))
+    preds = []
+    for b, num in enumerate(data["mask0"].sum(1).tolist()):
+        preds.append({k: pred[k][b : b + 1, :num] for k in pred if k.endswith("0")})
+    return preds
 
-def writer_fn(inp, match_path):
-    pair, pred = inp
-    with h5py.File(str(match_path), "a", libver="latest") as fd:
+
+def order_pairs(pairs: List[Tuple[str]], order: str = "greedy") -> List[Tuple[str]]:
+    """Order the pairs such that consecutive pairs share images, which are then
+    read once and served from the feature cache.
+    - query: group the pairs by their first image, in order of appearance.
+    - greedy: walk the pair graph: match all the remaining pairs of an image,
+      then continue from the last image read if it still has pairs, otherwise
+      from the image with the most remaining pairs.
+    - none: keep the order of the pairs.
+    """
+    if order == "none":
+        return list(pairs)
+    if order == "query":
+        first = {}
+        for name0, _ in pairs:
+            first.setdefault(name0, len(first))
+        return sorted(pairs, key=lambda p: first[p[0]])
+    if order != "greedy":
+        raise ValueError(f"Unknown pair order {order}.")
+
+    pairs_per_image = defaultdict(list)
+    for idx, pair in enumerate(pairs):
+        for name in set(pair):
+            pairs_per_image[name].append(idx)
+    remaining = {name: len(indices) for name, indices in pairs_per_image.items()}
+    heap = [(-num, name) for name, num in remaining.items()]
+    heapq.heapify(heap)
+    done = [False] * len(pairs)
+    ordered = []
+    anchor = None
+    while len(ordered) < len(pairs):
+        if anchor is None:
+            num, anchor = heapq.heappop(heap)
+            if remaining[anchor] != -num:  # outdated entry
+                anchor = None
+                continue
+        indices = [idx for idx in pairs_per_image[anchor] if not done[idx]]
+        # Visit last the image with the most remaining pairs, the next anchor.
+        other = {idx: pairs[idx][pairs[idx][0] == anchor] for idx in indices}
+        indices.sort(key=lambda idx: remaining[other[idx]])
+        for idx in indices:
+            done[idx] = True
+            ordered.append(pairs[idx])
+            for name in set(pairs[idx]):
+                remaining[name] -= 1
+                if remaining[name] > 0:
+                    heapq.heappush(heap, (-remaining[name], name))
+        anchor = other[indices[-1]] if indices else None
+        if anchor is not None and remaining[anchor] == 0:
+            anchor = None
+    return ordered
+
+
+def split_in_batches(num: int, batch_size: int) -> List[List[int]]:
+    return [list(range(i, min(i + batch_size, num))) for i in range(0, num, batch_size)]
+
+
+def interleave_for_workers(batches: List, num_workers: int) -> List:
+    """Reorder the batches such that each DataLoader worker, which are handed
+    the batches in turn, reads a contiguous run of them. Consecutive pairs
+    share images, so they are then served from the cache of the same worker.
+    """
+    if num_workers <= 1:
+        return list(batches)
+    size, remainder = divmod(len(batches), num_workers)
+    runs = []
+    for worker in range(num_workers):
+        start = worker * size + min(worker, remainder)
+        runs.append(batches[start : start + size + (worker < remainder)])
+    # The first runs are the longest, so the last round still matches the turns.
+    return [run[i] for i in range(len(runs[0])) for run in runs if i < len(run)]
+
+
+def prepare_matches(pred: Dict[str, torch.Tensor]) -> Dict[str, np.ndarray]:
+    """Move the predictions of a pair to the host, in the format of match files."""
+    matches = {"matches0": pred["matches0"][0].cpu().short().numpy()}
+    if "matching_scores0" in pred:
+        matches["matching_scores0"] = pred["matching_scores0"][0].cpu().half().numpy()
+    return matches
+
+
+def write_matches(fd: h5py.File, items: List[Tuple[str, Dict]]):
+    """Write a batch of matches. Those still on the device are moved now."""
+    for pair, pred in items:
+        if isinstance(pred["matches0"], torch.Tensor):
+            pred = prepare_matches(pred)
         if pair in fd:
             del fd[pair]
         grp = fd.create_group(pair)
-        matches = pred["matches0"][0].cpu().short().numpy()
-        grp.create_dataset("matches0", data=matches)
-        if "matching_scores0" in pred:
-            scores = pred["matching_scores0"][0].cpu().half().numpy()
-            grp.create_dataset("matching_scores0", data=scores)
+        for k, v in pred.items():
+            grp.create_dataset(k, data=v)
 
 
 def main(
@@ -153,6 +324,12 @@ def main(
     matches: Optional[Path] = None,
     features_ref: Optional[Path] = None,
     overwrite: bool = False,
+    batch_size: int = 1,
+    pair_order: str = "greedy",
+    write_batch_size: int = 64,
+    flush_every: Optional[int] = None,
+    keep_on_device: bool = False,
+    cache_size: int = 64 * 2**20,
 ) -> Path:
     if isinstance(features, Path) or Path(features).exists():
         features_q = features
@@ -171,7 +348,20 @@ def main(
 
     if features_ref is None:
         features_ref = features_q
-    match_from_paths(conf, pairs, matches, features_q, features_ref, overwrite)
+    match_from_paths(
+        conf,
+        pairs,
+        matches,
+        features_q,
+        features_ref,
+        overwrite,
+        batch_size,
+        pair_order,
+        write_batch_size,
+        flush_every,
+        keep_on_device,
+        cache_size,
+    )
 
     return matches
 
@@ -207,7 +397,20 @@ def match_from_paths(
     feature_path_q: Path,
     feature_path_ref: Path,
     overwrite: bool = False,
+    batch_size: int = 1,
+    pair_order: str = "greedy",
+    write_batch_size: int = 64,
+    flush_every: Optional[int] = None,
+    keep_on_device: bool = False,
+    cache_size: int = 64 * 2**20,
 ) -> Path:
+    """Match the pairs and write the matches to match_path from a single handle,
+    by batches of write_batch_size pairs, flushing the file every flush_every
+    batches if given. With keep_on_device, the predictions stay on the device
+    until their batch is written, instead of being moved to the host after
+    each forward pass. Each DataLoader worker caches up to cache_size bytes of
+    features.
+    """
     logger.info(
         "Matching local features with configuration:" f"\n{pprint.pformat(conf)}"
     )
@@ -230,21 +433,44 @@ def match_from_paths(
     Model = dynamic_load(matchers, conf["model"]["name"])
     model = Model(conf["model"]).eval().to(device)
 
-    dataset = FeaturePairsDataset(pairs, feature_path_q, feature_path_ref)
+    pairs = order_pairs(pairs, pair_order)
+    dataset = FeaturePairsDataset(pairs, feature_path_q, feature_path_ref, cache_size)
+    # Consecutive pairs, which share images, are batched together. Matchers
+    # that do not support batching run on each pair of the batch in turn.
+    batches = split_in_batches(len(pairs), batch_size)
+    num_workers = 5
+    batches = interleave_for_workers(batches, num_workers)
     loader = torch.utils.data.DataLoader(
-        dataset, num_workers=5, batch_size=1, shuffle=False, pin_memory=True
+        dataset,
+        num_workers=num_workers,
+        batch_sampler=batches,
+        collate_fn=collate_pairs,
+        pin_memory=True,
     )
-    writer_queue = WorkQueue(partial(writer_fn, match_path=match_path), 5)
+    writer = H5Writer(match_path, write_matches, flush_every=flush_every)
 
-    for idx, data in enumerate(tqdm(loader, smoothing=0.1)):
-        data = {
-            k: v if k.startswith("image") else v.to(device, non_blocking=True)
-            for k, v in data.items()
-        }
-        pred = model(data)
-        pair = names_to_pair(*pairs[idx])
-        writer_queue.put((pair, pred))
-    writer_queue.join()
+    items = []
+    with writer, tqdm(total=len(pairs), smoothing=0.1) as pbar:
+        for indices, data in zip(batches, loader):
+            data = {k: v.to(device, non_blocking=True) for k, v in data.items()}
+            for idx, pred in zip(indices, forward_pairs(model, data)):
+                if not keep_on_device:
+                    pred = prepare_matches(pred)
+                items.append((names_to_pair(*pairs[idx]), pred))
+            if len(items) >= write_batch_size:
+                writer.put(items)
+                items = []
+            pbar.update(len(indices))
+        if len(items) > 0:
+            writer.put(items)
+    dataset.close()
+    stats = dataset.cache_stats()
+    logger.info(
+        "Feature cache hit rate: %.1f%%, read %.1fMB of %.1fMB of features.",
+        100 * stats["hit_rate"],
+        stats["bytes_read"] / 1e6,
+        stats["bytes_requested"] / 1e6,
+    )
     logger.info("Finished exporting matches.")
 
 
@@ -257,5 +483,23 @@ if __name__ == "__main__":
     parser.add_argument(
         "--conf", type=str, default="superglue", choices=list(confs.keys())
     )
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument(
+        "--pair_order", type=str, default="greedy", choices=["greedy", "query", "none"]
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=64 * 2**20,
+        help="maximum size in bytes of the feature cache of each worker",
+    )
     args = parser.parse_args()
-    main(confs[args.conf], args.pairs, args.features, args.export_dir)
+    main(
+        confs[args.conf],
+        args.pairs,
+        args.features,
+        args.export_dir,
+        batch_size=args.batch_size,
+        pair_order=args.pair_order,
+        cache_size=args.cache_size,
+    )
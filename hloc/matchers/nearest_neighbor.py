@@ -3,12 +3,20 @@ import torch
 from ..utils.base_model import BaseModel
 
 
-def find_nn(sim, ratio_thresh, distance_thresh):
+def find_nn(sim, ratio_thresh, distance_thresh, ratio_mask=None):
     sim_nn, ind_nn = sim.topk(2 if ratio_thresh else 1, dim=-1, largest=True)
+    return filter_nn(sim_nn, ind_nn, ratio_thresh, distance_thresh, ratio_mask)
+
+
+def filter_nn(sim_nn, ind_nn, ratio_thresh, distance_thresh, ratio_mask=None):
     dist_nn = 2 * (1 - sim_nn)
-    mask = torch.ones(ind_nn.shape[:-1], dtype=torch.bool, device=sim.device)
+    # Padded descriptors have a similarity of -inf.
+    mask = sim_nn[..., 0] > float("-inf")
     if ratio_thresh:
-        mask = mask & (dist_nn[..., 0] <= (ratio_thresh**2) * dist_nn[..., 1])
+        ratio_ok = dist_nn[..., 0] <= (ratio_thresh**2) * dist_nn[..., 1]
+        if ratio_mask is not None:
+            ratio_ok = ratio_ok | ~ratio_mask[:, None]
+        mask = mask & ratio_ok
     if distance_thresh:
         mask = mask & (dist_nn[..., 0] <= distance_thresh**2)
     matches = torch.where(mask, ind_nn[..., 0], ind_nn.new_tensor(-1))
@@ -16,6 +24,63 @@ def find_nn(sim, ratio_thresh, distance_thresh):
     return matches, scores
 
 
+def to_float(desc, scale=None):
+    """Convert fp16 or int8 descriptors to float32, with their int8 scales."""
+    desc = desc.float()
+    if scale is not None:
+        desc = desc * scale.float()[:, None]
+    return desc
+
+
+def merge_topk(sim_nn, ind_nn, k):
+    """Top-k along dim 1 of a few candidates, with ties broken towards the
+    lowest index such that the merge does not depend on their order."""
+    ind_nn, order = ind_nn.sort(dim=1)
+    sim_nn, order2 = sim_nn.gather(1, order).sort(dim=1, descending=True, stable=True)
+    return sim_nn[:, :k], ind_nn.gather(1, order2)[:, :k]
+
+
+def topk_chunked(
+    desc0, desc1, k, chunk_size, masks=None, scales=(None, None), columns=True
+):
+    """Top-k similarities of each descriptor of image0 in image1 and, if columns,
+    conversely. The similarity is computed by blocks of chunk_size rows and the
+    running top-k of the columns is updated with the top-k of each block."""
+    b, _, n = desc0.shape
+    m = desc1.shape[-1]
+    desc1 = to_float(desc1, scales[1])
+    # BLAS multiplies single rows with a different routine and rounding, so
+    # blocks have at least two rows for the result to be identical to the
+    # dense matcher.
+    starts = list(range(0, n, max(chunk_size, 2)))
+    if len(starts) > 1 and n - starts[-1] == 1:
+        starts.pop()
+    top0 = []
+    sim_nn1 = desc1.new_full((b, k, m), -float("inf"))
+    ind_nn1 = torch.zeros((b, k, m), dtype=torch.long, device=desc1.device)
+    # The block of similarities is reused to avoid fragmenting the host memory.
+    buffer = desc1.new_empty((b, max(chunk_size, 2) + 1, m))
+    for start, end in zip(starts, starts[1:] + [n]):
+        scale0 = None if scales[0] is None else scales[0][:, start:end]
+        desc0_block = to_float(desc0[..., start:end], scale0)
+        sim = torch.bmm(
+            desc0_block.transpose(1, 2), desc1, out=buffer[:, : end - start]
+        )
+        if masks is not None:
+            mask = masks[0][:, start:end, None] & masks[1][:, None]
+            sim.masked_fill_(~mask, -float("inf"))
+        top0.append(sim.topk(k, dim=-1, largest=True))
+        if not columns:
+            continue
+        sim_nn, ind_nn = sim.topk(min(k, end - start), dim=1, largest=True)
+        sim_nn1, ind_nn1 = merge_topk(
+            torch.cat([sim_nn1, sim_nn], 1), torch.cat([ind_nn1, ind_nn + start], 1), k
+        )
+    sim_nn0 = torch.cat([v for v, _ in top0], 1)
+    ind_nn0 = torch.cat([i for _, i in top0], 1)
+    return (sim_nn0, ind_nn0), (sim_nn1.transpose(1, 2), ind_nn1.transpose(1, 2))
+
+
 def mutual_check(m0, m1):
     inds0 = torch.arange(m0.shape[-1], device=m0.device)
     loop = torch.gather(m1, -1, torch.where(m0 > -1, m0, m0.new_tensor(0)))
@@ -29,17 +94,20 @@ class NearestNeighbor(BaseModel):
         "ratio_threshold": None,
         "distance_threshold": None,
         "do_mutual_check": True,
+        # Number of descriptors of image0 matched at once, None for all. This
+        # bounds the memory to chunk_size x M similarities with the same result.
+        "chunk_size": None,
     }
     required_inputs = ["descriptors0", "descriptors1"]
+    supports_batching = True
 
     def _init(self, conf):
         pass
 
     def _forward(self, data):
         if data["descriptors0"].size(-1) == 0 or data["descriptors1"].size(-1) == 0:
-            matches0 = torch.full(
-                data["descriptors0"].shape[:2], -1, device=data["descriptors0"].device
-            )
+            b, _, n = data["descriptors0"].shape
+            matches0 = torch.full((b, n), -1, device=data["descriptors0"].device)
             return {
                 "matches0": matches0,
                 "matching_scores0": torch.zeros_like(matches0),
@@ -47,14 +115,44 @@ class NearestNeighbor(BaseModel):
         ratio_threshold = self.conf["ratio_threshold"]
         if data["descriptors0"].size(-1) == 1 or data["descriptors1"].size(-1) == 1:
             ratio_threshold = None
+        ratio_mask = masks = None
+        if "mask0" in data:
+            # Padded batch of pairs: ignore the padding and, as for single
+            # pairs, skip the ratio test for pairs with a single keypoint.
+            masks = (data["mask0"], data["mask1"])
+            ratio_mask = (masks[0].sum(1) > 1) & (masks[1].sum(1) > 1)
+        thresholds = (ratio_threshold, self.conf["distance_threshold"], ratio_mask)
+        # A single descriptor in image1 is not worth chunking (see topk_chunked).
+        if self.conf["chunk_size"] is not None and data["descriptors1"].size(-1) > 1:
+            return self._forward_chunked(data, thresholds, masks)
+
         sim = torch.einsum("bdn,bdm->bnm", data["descriptors0"], data["descriptors1"])
-        matches0, scores0 = find_nn(
-            sim, ratio_threshold, self.conf["distance_threshold"]
+        if masks is not None:
+            sim.masked_fill_(~(masks[0][:, :, None] & masks[1][:, None]), -float("inf"))
+        matches0, scores0 = find_nn(sim, *thresholds)
+        if self.conf["do_mutual_check"]:
+            matches1, scores1 = find_nn(sim.transpose(1, 2), *thresholds)
+            matches0 = mutual_check(matches0, matches1)
+        return {
+            "matches0": matches0,
+            "matching_scores0": scores0,
+        }
+
+    def _forward_chunked(self, data, thresholds, masks):
+        """Same as the dense path but computes the similarity by blocks of rows,
+        in float32 for fp16 or int8 descriptors (with descriptors_scale0/1)."""
+        (sim_nn0, ind_nn0), (sim_nn1, ind_nn1) = topk_chunked(
+            data["descriptors0"],
+            data["descriptors1"],
+            2 if thresholds[0] else 1,
+            self.conf["chunk_size"],
+            masks,
+            (data.get("descriptors_scale0"), data.get("descriptors_scale1")),
+            self.conf["do_mutual_check"],
         )
+        matches0, scores0 = filter_nn(sim_nn0, ind_nn0, *thresholds)
         if self.conf["do_mutual_check"]:
-            matches1, scores1 = find_nn(
-                sim.transpose(1, 2), ratio_threshold, self.conf["distance_threshold"]
-            )
+            matches1, _ = filter_nn(sim_nn1, ind_nn1, *thresholds)
             matches0 = mutual_check(matches0, matches1)
         return {
             "matches0": matches0,
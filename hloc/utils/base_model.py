@@ -5,10 +5,17 @@ from copy import copy
 
 from torch import nn
 
+from .export import export_submodule
+
 
 class BaseModel(nn.Module, metaclass=ABCMeta):
     default_conf = {}
     required_inputs = []
+    # Whether _forward accepts batches with more than one element.
+    supports_batching = False
+    # Submodules that map an image-like tensor to tensors with traceable
+    # operations, with the shape of an example input, see `export`.
+    exportable_modules = {}
 
     def __init__(self, conf):
         """Perform some logic and call the _init method of the child model."""
@@ -16,6 +23,9 @@ class BaseModel(nn.Module, metaclass=ABCMeta):
         self.conf = conf = {**self.default_conf, **conf}
         self.required_inputs = copy(self.required_inputs)
         self._init(conf)
+        backend = conf.get("backend", "eager")
+        if backend != "eager":
+            self.export(backend)
         sys.stdout.flush()
 
     def forward(self, data):
@@ -24,6 +34,16 @@ class BaseModel(nn.Module, metaclass=ABCMeta):
             assert key in data, "Missing key {} in data".format(key)
         return self._forward(data)
 
+    def export(self, backend):
+        """Replace the exportable submodules by their TorchScript or ONNX
+        version, which is cached on disk. Both backends run on the CPU."""
+        if not self.exportable_modules:
+            raise ValueError(
+                f"{type(self).__name__} does not support the {backend} backend."
+            )
+        for name, example_shape in self.exportable_modules.items():
+            setattr(self, name, export_submodule(self, name, example_shape, backend))
+
     @abstractmethod
     def _init(self, conf):
         """To be implemented by the child class."""
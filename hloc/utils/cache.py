@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+import h5py
+
+from .. import logger
+from .io import update_h5_names_index
+
+
+class FeatureCache:
+    """Features stored by image content and extractor configuration.
+    Each entry is a small HDF5 file named after the hash of the image bytes,
+    in a directory specific to the configuration. Entries of all configurations
+    are evicted in least-recently-used order when the whole cache exceeds
+    `max_size` bytes.
+    """
+
+    def __init__(
+        self, root: Path, conf: Dict, max_size: Optional[int] = None, **options
+    ):
+        # Entries are only shared with identical export options, e.g. as_half.
+        conf = {
+            "model": conf["model"],
+            "preprocessing": conf["preprocessing"],
+            **options,
+        }
+        conf_str = json.dumps(conf, sort_keys=True, default=str)
+        self.cache_dir = Path(root)
+        self.root = Path(root, hashlib.sha1(conf_str.encode()).hexdigest()[:16])
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.max_size = max_size
+
+    def key(self, image_path: Path) -> str:
+        sha = hashlib.sha1()
+        with open(image_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def entry_path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.h5"
+
+    def __contains__(self, key: str) -> bool:
+        return self.entry_path(key).exists()
+
+    def load(self, feature_path: Path, name2key: Dict[str, str]):
+        """Copy the cached features of each image into the feature file."""
+        with h5py.File(str(feature_path), "a", libver="latest") as fd:
+            for name, key in name2key.items():
+                path = self.entry_path(key)
+                with h5py.File(str(path), "r", libver="latest") as fd_entry:
+                    if name in fd:
+                        del fd[name]
+                    fd_entry.copy(fd_entry["features"], fd, name=name)
+                os.utime(path)  # mark as recently used
+            update_h5_names_index(fd, name2key.keys())
+
+    def store(self, feature_path: Path, name2key: Dict[str, str]):
+        """Add the features of each image of the feature file to the cache."""
+        with h5py.File(str(feature_path), "r", libver="latest") as fd:
+            for name, key in name2key.items():
+                path = self.entry_path(key)
+                path.parent.mkdir(exist_ok=True)
+                # Write to a temporary file first so readers never see partial entries.
+                tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+                with h5py.File(str(tmp_path), "w", libver="latest") as fd_entry:
+                    fd.copy(fd[name], fd_entry, name="features")
+                os.replace(tmp_path, path)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits its size."""
+        if self.max_size is None:
+            return
+        entries = []
+        for path in self.cache_dir.glob("*/*/*.h5"):
+            try:
+                entries.append((path.stat(), path))
+            except FileNotFoundError:  # evicted by another process
+                continue
+        total_size = sum(s.st_size for s, _ in entries)
+        num_evicted = 0
+        for stat, path in sorted(entries, key=lambda x: x[0].st_mtime):
+            if total_size <= self.max_size:
+                break
+            try:
+                path.unlink()
+                num_evicted += 1
+            except FileNotFoundError:
+                pass
+            total_size -= stat.st_size
+        if num_evicted > 0:
+            logger.info(f"Evicted {num_evicted} entries from the feature cache.")
@@ -0,0 +1,91 @@
+"""
+Export the dense parts of the extractors to TorchScript or ONNX for faster
+inference on CPU. The exported graphs are cached in the torch hub directory,
+next to the weights, and are keyed by the model configuration.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+from typing import Tuple
+
+import torch
+from torch import nn
+
+from .. import logger
+
+backends = ("eager", "torchscript", "onnx")
+
+
+def get_export_path(model: nn.Module, name: str, backend: str) -> Path:
+    conf = {k: v for k, v in model.conf.items() if k != "backend"}
+    key = json.dumps([type(model).__name__, name, conf, torch.__version__], default=str)
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    suffix = ".pt" if backend == "torchscript" else ".onnx"
+    filename = f"{type(model).__name__.lower()}-{name}-{key}{suffix}"
+    return Path(torch.hub.get_dir(), "hloc", "exported", filename)
+
+
+class ONNXModule(nn.Module):
+    """Run an exported ONNX graph with ONNX Runtime on the CPU."""
+
+    def __init__(self, path: Path):
+        super().__init__()
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(
+            str(path), providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x: torch.Tensor):
+        outputs = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})
+        outputs = [torch.from_numpy(o).to(x.device) for o in outputs]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+@torch.no_grad()
+def export_module(module: nn.Module, example: torch.Tensor, path: Path, backend: str):
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp")
+    if backend == "torchscript":
+        torch.jit.save(torch.jit.trace(module, example), str(tmp_path))
+    elif backend == "onnx":
+        # All dimensions but the channels can change across inputs.
+        axes = {i: f"dim{i}" for i in range(example.dim()) if i != 1}
+        # Keep the TorchScript-based exporter, which is no longer the default in
+        # recent versions of torch. Versions before 2.5 do not take the argument.
+        kwargs = {}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            kwargs["dynamo"] = False
+        torch.onnx.export(
+            module,
+            (example,),
+            str(tmp_path),
+            input_names=["input"],
+            dynamic_axes={"input": axes},
+            **kwargs,
+        )
+    else:
+        raise ValueError(f"Unknown backend {backend}, choose from {backends}.")
+    os.replace(tmp_path, path)
+
+
+def load_exported_module(path: Path, backend: str) -> nn.Module:
+    if backend == "torchscript":
+        return torch.jit.freeze(torch.jit.load(str(path), map_location="cpu").eval())
+    return ONNXModule(path)
+
+
+def export_submodule(
+    model: nn.Module, name: str, example_shape: Tuple[int], backend: str
+) -> nn.Module:
+    """Return the exported version of the submodule `name` of `model`."""
+    path = get_export_path(model, name, backend)
+    if not path.exists():
+        logger.info(f"Exporting {type(model).__name__}.{name} to {path}.")
+        module = getattr(model, name).eval()
+        export_module(module, torch.rand(example_shape), path, backend)
+    return load_exported_module(path, backend)
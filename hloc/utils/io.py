@@ -1,18 +1,31 @@
+import logging
+from itertools import chain
 from pathlib import Path
-from typing import Tuple
+from queue import Queue
+from threading import Thread
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
-import cv2
 import h5py
 import numpy as np
 
 from .parsers import names_to_pair, names_to_pair_old
 
+logger = logging.getLogger(__name__)
+
+
+def read_image(path, grayscale=False, reduction=1):
+    """Read an image, optionally downscaled by 2, 4, or 8 while decoding it,
+    which is much faster for JPEG images."""
+    import cv2
 
-def read_image(path, grayscale=False):
     if grayscale:
         mode = cv2.IMREAD_GRAYSCALE
     else:
         mode = cv2.IMREAD_COLOR
+    if reduction != 1:
+        mode = getattr(
+            cv2, f"IMREAD_REDUCED_{'GRAYSCALE' if grayscale else 'COLOR'}_{reduction}"
+        )
     image = cv2.imread(str(path), mode)
     if image is None:
         raise ValueError(f"Cannot read image {path}.")
@@ -21,18 +34,94 @@ def read_image(path, grayscale=False):
     return image
 
 
-def list_h5_names(path):
+def get_image_size(path) -> Tuple[int, int]:
+    """Read the width and height of an image from its header."""
+    import PIL.Image
+
+    with PIL.Image.open(str(path)) as image:
+        return image.size
+
+
+def quantize(descriptors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantize DxN descriptors to int8 with one scale per descriptor."""
+    descriptors = descriptors.astype(np.float32)
+    scale = np.abs(descriptors).max(0) / 127
+    scale[scale == 0] = 1
+    quantized = np.round(descriptors / scale).astype(np.int8)
+    return quantized, scale
+
+
+def dequantize(quantized: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    return quantized.astype(np.float32) * scale
+
+
+def read_features(grp: h5py.Group) -> Dict[str, np.ndarray]:
+    """Read all the features of an image and dequantize its descriptors."""
+    return dequantize_features({k: v.__array__() for k, v in grp.items()})
+
+
+def dequantize_features(features: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Dequantize the descriptors of features as stored, if they are quantized."""
+    features = dict(features)
+    if "descriptors_scale" in features:
+        scale = features.pop("descriptors_scale")
+        features["descriptors"] = dequantize(features["descriptors"], scale)
+    return features
+
+
+# Root dataset that lists the names of the groups written by hloc. It can only
+# grow, so adding names does not rewrite it. Readers that scan all datasets of
+# a file, like hloc before the index, need to skip it.
+NAMES_INDEX = "__names__"
+
+
+def scan_h5_names(fd: h5py.File) -> List[str]:
     names = []
-    with h5py.File(str(path), "r", libver="latest") as fd:
 
-        def visit_fn(_, obj):
-            if isinstance(obj, h5py.Dataset):
-                names.append(obj.parent.name.strip("/"))
+    def visit_fn(_, obj):
+        if isinstance(obj, h5py.Dataset) and obj.name != "/" + NAMES_INDEX:
+            names.append(obj.parent.name.strip("/"))
 
-        fd.visititems(visit_fn)
+    fd.visititems(visit_fn)
     return list(set(names))
 
 
+def read_h5_names_index(fd: h5py.File) -> List[str]:
+    return [n.decode() if isinstance(n, bytes) else n for n in fd[NAMES_INDEX][()]]
+
+
+def list_h5_names(path, use_index: bool = True) -> List[str]:
+    """List the names of the groups of a file. Use the index written by hloc
+    if there is one, otherwise scan all datasets, which is slow for large files.
+    """
+    with h5py.File(str(path), "r", libver="latest") as fd:
+        if use_index and NAMES_INDEX in fd:
+            return list(set(read_h5_names_index(fd)))
+        return scan_h5_names(fd)
+
+
+def update_h5_names_index(fd: h5py.File, names: Iterable[str]):
+    """Append the new names to the index of a file opened for writing. If the
+    file does not have an index yet, its existing groups are indexed first."""
+    if NAMES_INDEX in fd:
+        index = fd[NAMES_INDEX]
+        indexed = set(read_h5_names_index(fd))
+    else:
+        names = chain(scan_h5_names(fd), names)
+        index = fd.create_dataset(
+            NAMES_INDEX,
+            shape=(0,),
+            maxshape=(None,),
+            dtype=h5py.string_dtype(),
+            chunks=(4096,),
+        )
+        indexed = set()
+    new_names = [n for n in dict.fromkeys(names) if n not in indexed]
+    if len(new_names) > 0:
+        index.resize((len(index) + len(new_names),))
+        index[-len(new_names) :] = new_names
+
+
 def get_keypoints(
     path: Path, name: str, return_uncertainty: bool = False
 ) -> np.ndarray:
@@ -76,3 +165,87 @@ def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
         matches = np.flip(matches, -1)
     scores = scores[idx]
     return matches, scores
+
+
+class H5Writer:
+    """Write to an HDF5 file that stays open in a background thread.
+    Each item passed to `put` is written with `write_fn(fd, item)`. The caller
+    only blocks when the bounded queue is full. Closing the writer, also when
+    leaving its context because of an exception or an interrupt, writes all
+    queued items and then flushes and closes the file. If `write_fn` returns
+    the name of the group that it wrote, the name is added to the index of
+    the file when it is flushed or closed.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        write_fn: Callable[[h5py.File, Any], None],
+        queue_size: int = 16,
+        flush_every: Optional[int] = None,
+    ):
+        self.path = path
+        self.write_fn = write_fn
+        self.flush_every = flush_every
+        self.error = None
+        self.queue = Queue(queue_size)
+        self.thread = Thread(target=self.thread_fn, daemon=True)
+        self.thread.start()
+
+    def thread_fn(self):
+        try:
+            fd = h5py.File(str(self.path), "a", libver="latest")
+        except Exception as error:
+            fd, self.error = None, error
+        num_written = 0
+        names = []
+        item = self.queue.get()
+        while item is not None:
+            # After a failure we keep emptying the queue to never block the caller.
+            if self.error is None:
+                try:
+                    name = self.write_fn(fd, item)
+                    if name is not None:
+                        names.append(name)
+                    num_written += 1
+                    if self.flush_every and num_written % self.flush_every == 0:
+                        self.flush(fd, names)
+                except Exception as error:
+                    self.error = error
+            item = self.queue.get()
+        if fd is not None:
+            try:
+                self.flush(fd, names)
+            except Exception as error:
+                self.error = self.error or error
+            finally:
+                fd.close()
+
+    def flush(self, fd: h5py.File, names: List[str]):
+        if len(names) > 0:
+            update_h5_names_index(fd, names)
+            names.clear()
+        fd.flush()
+
+    def put(self, item: Any):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except Exception as error:
+                logger.error("Failed to write to %s: %s", self.path, error)
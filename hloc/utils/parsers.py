@@ -3,7 +3,6 @@ from collections import defaultdict
 from pathlib import Path
 
 import numpy as np
-import pycolmap
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +16,8 @@ def parse_image_list(path, with_intrinsics=False):
                 continue
             name, *data = line.split()
             if with_intrinsics:
+                import pycolmap
+
                 model, width, height, *params = data
                 params = np.array(params, float)
                 cam = pycolmap.Camera(
@@ -58,13 +59,14 @@ def names_to_pair(name0, name1, separator="/"):
 def names_to_pair_old(name0, name1):
     return names_to_pair(name0, name1, separator="_")
 
+
 def group_and_sort_image_pairs_with_labels(pairs):
     grouped_results = defaultdict(list)
     for query, database, score in pairs:
         label = f"score: {score:.2f}"
         grouped_results[query].append((database, score, label))
-    
+
     for query in grouped_results:
         grouped_results[query].sort(key=lambda x: x[1], reverse=True)  # Sort by score
-    
+
     return grouped_results
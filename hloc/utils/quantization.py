@@ -0,0 +1,87 @@
+"""
+Int8 quantization of the global descriptor backbones for faster inference on
+CPU. Linear layers are quantized dynamically, while convolutional backbones are
+quantized statically with activation ranges calibrated on a few images.
+Quantized modules only run on the CPU.
+"""
+
+from pathlib import Path
+from typing import Callable, List
+
+import torch
+from torch import nn
+
+from .. import logger
+from .io import read_image
+
+
+def set_submodule(model: nn.Module, name: str, module: nn.Module):
+    parent, _, child = name.rpartition(".")
+    setattr(model.get_submodule(parent), child, module)
+
+
+def quantize_dynamic(model: nn.Module, names: List[str]):
+    """Quantize the weights of the Linear layers of the given submodules."""
+    for name in names:
+        module = torch.ao.quantization.quantize_dynamic(
+            model.get_submodule(name), {nn.Linear}, dtype=torch.qint8
+        )
+        set_submodule(model, name, module)
+
+
+@torch.no_grad()
+def quantize_static(
+    model: nn.Module,
+    names: List[str],
+    calibration_images: List[torch.Tensor],
+    run_fn: Callable,
+):
+    """Quantize the weights and activations of the given submodules with FX
+    graph mode. `run_fn(image)` runs the full model on a calibration image."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    model.eval()
+    # Record example inputs of each submodule for the symbolic tracing.
+    examples = {}
+    hooks = [
+        model.get_submodule(name).register_forward_pre_hook(
+            lambda _, args, name=name: examples.setdefault(name, args)
+        )
+        for name in names
+    ]
+    run_fn(calibration_images[0])
+    for hook in hooks:
+        hook.remove()
+
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    for name in names:
+        module = model.get_submodule(name).eval()
+        set_submodule(model, name, prepare_fx(module, qconfig_mapping, examples[name]))
+    for image in calibration_images:
+        run_fn(image)
+    for name in names:
+        set_submodule(model, name, convert_fx(model.get_submodule(name)))
+
+
+def load_calibration_images(
+    image_dir: Path, num_images: int = 16, resize_max: int = 1024
+) -> List[torch.Tensor]:
+    """Read a few RGB images in [0, 1] resized as by the extraction confs."""
+    from ..extract_features import ImageDataset, find_images, resize_image
+
+    names = find_images(image_dir, ImageDataset.default_conf["globs"])[:num_images]
+    if len(names) == 0:
+        raise ValueError(f"Could not find any calibration image in {image_dir}.")
+    logger.info(f"Calibrating the quantization with {len(names)} images.")
+
+    images = []
+    for name in names:
+        image = read_image(Path(image_dir, name))
+        scale = resize_max / max(image.shape[:2])
+        if scale < 1:
+            size = tuple(int(round(x * scale)) for x in image.shape[:2][::-1])
+            image = resize_image(image, size, "cv2_area")
+        image = torch.from_numpy(image.transpose((2, 0, 1)).copy()).float() / 255.0
+        images.append(image[None])
+    return images
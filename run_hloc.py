@@ -45,8 +45,9 @@ results_path = output_path / 'query_localization_results.txt'
 # ---------------------------------------------------
 
 # detect feature points on query images, extract NetVLAD descriptors for query images
-query_feature_path = extract_features.main(feature_conf, query_images_path, output_path)
-query_descriptors_path = extract_features.main(retrieval_conf, query_images_path, output_path)
+# (both in a single pass that decodes each query image only once)
+query_feature_path, query_descriptors_path = extract_features.main_multi(
+    [feature_conf, retrieval_conf], query_images_path, output_path)
 
 # global descriptor matching
 pairs_from_retrieval.main(query_descriptors_path, query_pairs_path, 50, query_prefix='query', \
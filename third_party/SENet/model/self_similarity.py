@@ -1,12 +1,16 @@
 # written by Seongwon Lee (won4113@yonsei.ac.kr)
 
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
 class SSM(nn.Module):
-    def __init__(self, in_ch, mid_ch, unfold_size=7, ksize=3):
+    def __init__(self, in_ch, mid_ch, unfold_size=7, ksize=3, chunk_size=None):
         super(SSM, self).__init__()
+        # In eval mode, process the self-similarity volume by chunks of rows
+        # of this size to bound the memory, since it is 49x the feature map.
+        self.chunk_size = chunk_size
         
         self.ch_reduction_encoder = nn.Conv2d(in_ch, mid_ch, kernel_size=1, bias=False, padding=0)
         self.SCC = SelfCorrelationComputation(unfold_size=unfold_size)
@@ -20,8 +24,16 @@ class SSM(nn.Module):
         q = self.ch_reduction_encoder(ssm_input_feat)
         q = F.normalize(q, dim=1, p=2)
             
-        self_sim = self.SCC(q)
-        self_sim_feat = self.SSE(self_sim)
+        if self.chunk_size is None or self.training:
+            self_sim = self.SCC(q)
+            self_sim_feat = self.SSE(self_sim)
+        else:
+            # BatchNorm uses running statistics in eval mode, so the rows of
+            # the volume can be encoded independently.
+            h = q.shape[2]
+            pooled = [self.SSE.encode(self.SCC(q, (i, min(i + self.chunk_size, h))))
+                      for i in range(0, h, self.chunk_size)]
+            self_sim_feat = self.SSE.conv1x1_out(torch.cat(pooled, dim=2))
         ssm_output_feat = ssm_input_feat + self_sim_feat
         ssm_output_feat = self.FFN(ssm_output_feat)
 
@@ -34,7 +46,25 @@ class SelfCorrelationComputation(nn.Module):
         self.padding_size = unfold_size // 2
         self.unfold = nn.Unfold(kernel_size=self.unfold_size, padding=self.padding_size)
 
-    def forward(self, q):
+    def forward(self, q, rows=None):
+        """Compute the b, c, h, w, u, v volume of the products of each feature
+        with its neighbors, optionally only for the rows [start, end). This
+        multiplies shifted copies of the feature map instead of unfolding it."""
+        b, c, h, w = q.shape
+        start, end = (0, h) if rows is None else rows
+        p = self.padding_size
+        q_pad = F.pad(q[:, :, max(start - p, 0):end + p], (p, p, max(p - start, 0), max(end + p - h, 0)))
+        q = q[:, :, start:end]
+
+        self_sim = q.new_empty(b, c, end - start, w, *self.unfold_size)
+        for u in range(self.unfold_size[0]):
+            for v in range(self.unfold_size[1]):
+                self_sim[..., u, v] = q_pad[:, :, u:u + end - start, v:v + w] * q
+
+        return self_sim.clamp_(min=0)
+
+    def forward_unfold(self, q):
+        """Original implementation, which materializes the unfolded features."""
         b, c, h, w = q.shape
 
         q_unfold = self.unfold(q)  # b, cuv, h, w
@@ -43,7 +73,7 @@ class SelfCorrelationComputation(nn.Module):
         self_sim = self_sim.permute(0, 1, 4, 5, 2, 3).contiguous()  # b, c, h, w, u, v
 
         return self_sim.clamp(min=0)
-        
+
 class SelfSimilarityEncoder(nn.Module):
     def __init__(self, in_ch, mid_ch, unfold_size, ksize):
         super(SelfSimilarityEncoder, self).__init__()
@@ -63,13 +93,17 @@ class SelfSimilarityEncoder(nn.Module):
             nn.Conv2d(mid_ch, in_ch, kernel_size=1, bias=True, padding=0),
             nn.BatchNorm2d(in_ch))
 
-    def forward(self, x):
+    def encode(self, x):
         b, c, h, w, u, v = x.shape
 
         x = x.view(b, c, h * w, u, v)
         x = self.conv_in(x)
         c = x.shape[1]
         x = x.mean(dim=[-1,-2]).view(b, c, h, w)
+        return x
+
+    def forward(self, x):
+        x = self.encode(x)
         x = self.conv1x1_out(x)  # [B, C3, H, W] -> [B, C4, H, W]
 
         return x